@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import logging
 import numpy as np
 import os
@@ -14,55 +15,111 @@ from utils.tokenizer import Tokenizer
 from model import AggTrainingModule
 from dataloader import AggDataModule
 from inference import AggInferenceModule
+from utils.streaming import chunks, input_filename, read_examples, ExampleWriter, ResumableWriter
 
 logger = logging.getLogger(__name__)
 
 class AggModule:
-    def __init__(self, model_path, separator):
+    def __init__(self, model_path, separator, log_every=100, batch_size=16, resume=False, sync_every=100):
         self.model = AggInferenceModule(args, model_path=model_path)
         self.separator = separator
+        # log the progress after every n-th example (0 = no logging)
+        self.log_every = log_every
+        self.batch_size = batch_size
+        # write the outputs to a journal and skip the examples completed in the previous run
+        self.resume = resume
+        self.sync_every = sync_every
 
-    def aggregate_dataset(self, in_filename, out_filename):
+    def _read_examples(self, in_filename, stream):
+        if stream:
+            return read_examples(in_filename)
+
+        with open(in_filename) as in_file:
+            return json.load(in_file)["data"]
+
+    def _predict_examples(self, examples, completed=None):
+        """
+        Predict the separators for the examples in batches. Yields batches of (example, separators) pairs
+        (separators are None for trivial examples with a single sentence and for the examples
+        with the indices in `completed`).
+        """
+        if completed is None:
+            completed = set()
+
+        # the batches read but not predicted yet (the next batches are tokenized while the model runs)
+        pending = collections.deque()
+
+        def to_predict():
+            offset = 0
+
+            for batch in chunks(examples, self.batch_size):
+                predicted = [len(example["sents"]) > 1 and offset + k not in completed for k, example in enumerate(batch)]
+                pending.append((batch, predicted))
+                offset += len(batch)
+
+                yield [example["sents"] for example, p in zip(batch, predicted) if p]
+
+        for seps_batch in self.model.predict_batches(to_predict()):
+            batch, predicted = pending.popleft()
+            seps_batch = iter(seps_batch)
+
+            yield [(example, next(seps_batch) if p else None) for example, p in zip(batch, predicted)]
+
+    def aggregate_dataset(self, in_filename, out_filename, stream=False):
         """
         Create JSON file which can be processed by the paragraph compression model.
         Separators (<sep>) are inserted in the source texts according to the model predictions, target is copied.
+        In the streaming mode, the examples are read incrementally and written to a JSONL file (one example per line).
         """
-        output = {
-            "data" : []
-        }
-        with open(in_filename) as in_file:
-            j = json.load(in_file)
+        if self.resume:
+            writer = ResumableWriter(out_filename, format="jsonl" if stream else "json", sync_every=self.sync_every)
+            logger.info(f"Resuming aggregation, {len(writer.completed)} outputs completed")
+        else:
+            writer = ExampleWriter(out_filename, stream=stream)
+
+        completed = getattr(writer, "completed", set())
+        i = 0
+
+        for batch in self._predict_examples(self._read_examples(in_filename, stream), completed):
+            for example, seps in batch:
+                if i in completed:
+                    i += 1
+                    continue
 
-            for i, example in enumerate(j["data"]):
                 sents = example["sents"]
                 out = []
 
-                if len(sents) == 1:
+                if seps is None:
                     out = sents
                 else:
-                    seps = self.model.predict(sents)
                     for j in range(len(sents)):
                         out.append(sents[j])
 
                         if j < len(seps) and seps[j] == 1:
                             out.append(self.separator)
-                
-                if i % 100 == 0:
+
+                if self.log_every and i % self.log_every == 0:
                     logger.info(f"{i} examples aggregated")
-                
+
                 example_sorted = {
                     "sents" : " ".join(out),
                     "text" : example["text"]
                 }
-                output["data"].append(example_sorted)
+                writer.write(example_sorted, idx=i)
+                i += 1
+
+            if stream:
+                writer.flush()
 
-        with open(os.path.join(out_filename), "w") as f:
-            json.dump(output, f, indent=4, ensure_ascii=False)
+        writer.close(i)
 
+        self.model.pipeline.log_stats()
         logger.info("Aggregation finished.")
 
+    def _pad(self, lists, length, value=-1):
+        return np.array([l + [value] * (length - len(l)) for l in lists], dtype=np.int64)
 
-    def aggregate_dataset_eval(self, in_filename):
+    def aggregate_dataset_eval(self, in_filename, stream=False):
         """
         Run the aggregation model and compute evaluation metrics.
         """
@@ -73,37 +130,28 @@ class AggModule:
         total = 0
         total_pos = 0
 
-        with open(in_filename) as in_file:
-            j = json.load(in_file)
-            for i, example in enumerate(j["data"]):
+        for batch in self._predict_examples(self._read_examples(in_filename, stream)):
+            total += len(batch)
+            # skip trivial examples
+            batch = [(seps, example["sep"]) for example, seps in batch if seps is not None]
 
-                try:
-                    total += 1
-                    sents = example["sents"]
+            if not batch:
+                continue
 
-                    if len(sents) == 1:
-                        # skip trivial examples
-                        continue
+            preds, golds = zip(*batch)
+            length = max(len(l) for l in preds + golds)
 
-                    out = []
-                    seps = self.model.predict(sents)
+            preds = self._pad(list(preds), length)
+            golds = self._pad(list(golds), length)
+            # the random baseline predicts the same number of separators as the model
+            mask = preds != -1
+            randoms = np.where(mask, np.random.randint(2, size=preds.shape), -1)
 
-                    if seps == example['sep']:
-                        correct_agg += 1
-
-                    random_seps = list(np.random.randint(2, size=len(seps)))
-
-                    if random_seps == example['sep']:
-                        correct_random += 1
-
-                    for j, (s, r) in enumerate(zip(seps, random_seps)):
-                        total_pos += 1
-                        if s == example["sep"][j]:
-                            correct_agg_perpos += 1
-                        if r == example["sep"][j]:
-                            correct_random_perpos += 1
-                except:
-                    logger.error("Something ugly happenned. This should not happen often.")
+            correct_agg += (preds == golds).all(-1).sum()
+            correct_random += (randoms == golds).all(-1).sum()
+            correct_agg_perpos += ((preds == golds) & mask).sum()
+            correct_random_perpos += ((randoms == golds) & mask).sum()
+            total_pos += mask.sum()
 
         print(f"Accuracy - random: {correct_random/total:.2f} ({correct_random}/{total})")
         print(f"Accuracy - agg module: {correct_agg/total:.2f} ({correct_agg}/{total})")
@@ -135,6 +183,9 @@ if __name__ == "__main__":
         help="Number of GPUs.")
     parser.add_argument("--max_length", type=int, default=1024,
         help="Maximum number of tokens per example")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"],
+        help="Apply dynamic quantization to the Linear layers of the model for CPU inference. The quantized model \
+            is saved next to the checkpoint and loaded in the next runs.")
     parser.add_argument("--checkpoint", type=str, default="model.ckpt",
         help="Override the default checkpoint name 'model.ckpt'.")
     parser.add_argument('--splits', type=str, nargs='+', default=["test"],
@@ -143,6 +194,22 @@ if __name__ == "__main__":
                     help='Run evaluation')
     parser.add_argument("--separator", type=str, default="<sep>",
         help="Separator token.")
+    parser.add_argument('--stream', action="store_true",
+                    help='Read the input incrementally (JSONL input is used if available) and write the output \
+                        as JSONL after each example.')
+    parser.add_argument("--batch_size", type=int, default=16,
+        help="Number of examples processed in a single batch.")
+    parser.add_argument("--log_every", type=int, default=100,
+        help="Log the progress after every n-th example (0 = no logging).")
+    parser.add_argument("--prefetch_batches", type=int, default=0,
+        help="Tokenize up to this number of next batches and post-process the previous batches in background threads \
+            while the model runs (0 = sequential processing). The time the model waits for them is logged.")
+    parser.add_argument('--resume', action="store_true",
+                    help='Write the outputs to a journal <output file>.partial synced to the disk periodically and skip \
+                        the examples already in the journal if the previous run was interrupted. The output file is \
+                        written at the end.')
+    parser.add_argument("--sync_every", type=int, default=100,
+        help="Number of outputs after which the journal is synced to the disk (with --resume).")
     args = parser.parse_args()
 
     logger.info(args)
@@ -153,7 +220,11 @@ if __name__ == "__main__":
 
     model_path = os.path.join(args.exp_dir, args.experiment, args.checkpoint)
     dam = AggModule(model_path,
-        args.separator)
+        args.separator,
+        log_every=args.log_every,
+        batch_size=args.batch_size,
+        resume=args.resume,
+        sync_every=args.sync_every)
 
     out_dir = args.out_dir
 
@@ -161,12 +232,21 @@ if __name__ == "__main__":
         os.makedirs(out_dir, exist_ok=True)
 
     for split in args.splits:
+        if args.stream:
+            in_filename = input_filename(args.in_dir, split)
+            out_ext = "jsonl"
+        else:
+            in_filename = os.path.join(args.in_dir, f"{split}.json")
+            out_ext = "json"
+
         if args.eval:
             dam.aggregate_dataset_eval(
-                in_filename=os.path.join(args.in_dir, f"{split}.json"),
+                in_filename=in_filename,
+                stream=args.stream
             )
         else:
             dam.aggregate_dataset(
-                in_filename=os.path.join(args.in_dir, f"{split}.json"),
-                out_filename=os.path.join(out_dir, f"{split}.json")
-            )
\ No newline at end of file
+                in_filename=in_filename,
+                out_filename=os.path.join(out_dir, f"{split}.{out_ext}"),
+                stream=args.stream
+            )
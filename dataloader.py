@@ -11,8 +11,9 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import random
+import functools
 
-from torch.utils.data import DataLoader, Dataset
+from torch.utils.data import DataLoader, Dataset, Sampler
 from data import get_dataset_class
 from collections import defaultdict
 from datasets import load_dataset, dataset_dict, Dataset
@@ -25,6 +26,52 @@ logger = logging.getLogger(__name__)
 """
 Classes for loading data from raw JSONs into PyTorch Lightning DataModule
 """
+class LengthGroupedBatchSampler(Sampler):
+    """
+    Batch sampler grouping examples of similar length (to minimize the padding in each batch).
+    If `shuffle` is set, the examples are shuffled, split into chunks of `batch_size * megabatch_mult` examples
+    which are sorted by length, and the resulting batches are shuffled again (differently in each epoch).
+    Otherwise, all the examples are sorted by length.
+    """
+    def __init__(self, lengths, batch_size, shuffle=True, megabatch_mult=50):
+        self.lengths = np.array(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.megabatch_size = batch_size * megabatch_mult
+
+    def __len__(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            idxs = np.random.permutation(len(self.lengths))
+            megabatches = [idxs[i:i+self.megabatch_size] for i in range(0, len(idxs), self.megabatch_size)]
+            idxs = np.concatenate([mb[np.argsort(-self.lengths[mb], kind="stable")] for mb in megabatches])
+        else:
+            idxs = np.argsort(-self.lengths, kind="stable")
+
+        batches = [idxs[i:i+self.batch_size].tolist() for i in range(0, len(idxs), self.batch_size)]
+
+        if self.shuffle:
+            np.random.shuffle(batches)
+
+        return iter(batches)
+
+
+class IndexedDataset(torch.utils.data.Dataset):
+    """
+    Dataset wrapper returning the examples together with their indices.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        return idx, self.dataset[idx]
+
+
 class D2TDataModule(pl.LightningDataModule):
     """
     Common PL DataModule methods
@@ -115,6 +162,33 @@ class D2TDataModule(pl.LightningDataModule):
           collate_fn=self._pad_sequence
         )
 
+    def decode_dataloader(self, split, idxs=None):
+        """
+        Dataloader for decoding: the examples are sorted by input length to minimize the padding in each batch.
+        The indices of the examples in the original order (in `idxs` if only the examples `idxs` are selected)
+        are added to the batches ("example_idx").
+        """
+        dataset = self.dataset[split]
+
+        if idxs is not None:
+            dataset = dataset.select(idxs)
+
+        with dataset.formatted_as(type=None, columns=["input_ids"]):
+            lengths = [len(ids) for ids in dataset["input_ids"]]
+
+        return DataLoader(IndexedDataset(dataset),
+            batch_sampler=LengthGroupedBatchSampler(lengths, self.args.batch_size, shuffle=False),
+            num_workers=self.args.max_threads,
+            collate_fn=self._collate_indexed
+        )
+
+    def _collate_indexed(self, batch):
+        idxs, examples = zip(*batch)
+        batch_collated = self._pad_sequence(examples)
+        batch_collated["example_idx"] = torch.tensor(idxs)
+
+        return batch_collated
+
     def _pad_sequence(self, batch):
         """
         Align sentence endings (=add paddings)
@@ -124,9 +198,12 @@ class D2TDataModule(pl.LightningDataModule):
         paddings = {
             "input_ids" : self.tokenizer.pad_token_id,
             "attention_mask" : 0,
-            "labels" : -100
+            "decoder_input_ids" : self.tokenizer.pad_token_id,
+            "decoder_attention_mask" : 0,
+            "labels" : -100,
+            "agg_labels" : -100
         }
-        for key in ["input_ids", "attention_mask", "labels"]:
+        for key in batch[0].keys():
             elems = [x[key] for x in batch]
             elems_pad = pad_sequence(elems, batch_first=True, padding_value=paddings[key])
             batch_collated[key] = elems_pad
@@ -140,35 +217,42 @@ class OrdDataModule(D2TDataModule):
     """
     def __init__(self, args, model_name=None):
         super().__init__(args, model_name)
-
-    def train_dataloader(self):
-        return DataLoader(
-            self.dataset['train'],
-            batch_size=self.args.batch_size,
+        self.lengths = {}
+        # add the labels for the aggregation head (see OrdAggDataModule)
+        self.aggregation = False
+        # tokens between <s> and the first </s> in the decoder input
+        self.decoder_prefix = self.tokenizer(" ", add_special_tokens=False)["input_ids"]
+
+    def _dataloader(self, split, shuffle):
+        # examples are padded dynamically to the longest example in a batch of examples with similar length
+        return DataLoader(self.dataset[split],
+            batch_sampler=LengthGroupedBatchSampler(self.lengths[split], self.args.batch_size, shuffle=shuffle),
             num_workers=self.args.max_threads,
+            collate_fn=functools.partial(self._collate, shuffle=shuffle)
         )
 
+    def train_dataloader(self):
+        return self._dataloader('train', shuffle=True)
+
     def val_dataloader(self):
-        return DataLoader(self.dataset['dev'],
-             batch_size=self.args.batch_size,
-             num_workers=self.args.max_threads,
-        )
+        return self._dataloader('dev', shuffle=False)
 
     def test_dataloader(self):
-        return DataLoader(self.dataset['test'],
-          batch_size=self.args.batch_size,
-          num_workers=self.args.max_threads,
-        )
+        return self._dataloader('test', shuffle=False)
 
     def _process_raw_dataset(self, raw_dataset):
         dataset = {}
 
         for split in raw_dataset.keys():
-            columns = ["input_ids", "attention_mask", "decoder_input_ids", "decoder_attention_mask"]
-            columns_to_remove = ["sents", "sep"]
+            columns = ["tokens", "sent_lengths", "first_tokens", "first_lengths", "last_tokens", "permutation"]
+            columns_to_remove = ["sents"]
+
+            if self.aggregation:
+                columns.append("sep")
+            else:
+                columns_to_remove.append("sep")
 
             if "text" in raw_dataset[split].features.keys():
-                columns.append("labels")
                 columns_to_remove.append("text")
 
             dataset[split] = raw_dataset[split].map(
@@ -176,74 +260,177 @@ class OrdDataModule(D2TDataModule):
                 remove_columns=columns_to_remove,
                 batched=True
             )
+            self.lengths[split] = dataset[split]["length"]
             dataset[split].set_format(
-                type="torch",
+                type="numpy",
                 columns=columns
             )
         return dataset
 
     def _convert_to_features(self, example_batch, indices=None):
+        """
+        Tokenize the sentences of each example once. The sentences are stored as token spans (concatenated tokens
+        + lengths of the sentences), the model inputs are assembled in the collate function.
+        """
+        sents_batch = example_batch["sents"]
+        flat_sents = [sent for sents in sents_batch for sent in sents]
+
+        # the sentences are tokenized in the same contexts as in the joined text "s_1 </s><s> s_2 </s><s> ...":
+        # with the surrounding spaces, without the leading space (the first sentence in the encoder)
+        # and without the trailing space (the last sentence in the decoder)
+        spans = self.tokenizer([f" {sent} " for sent in flat_sents], add_special_tokens=False)["input_ids"]
+        first_spans = self.tokenizer([f"{sent} " for sent in flat_sents], add_special_tokens=False)["input_ids"]
+        last_spans = self.tokenizer(
+            [f" {sents[-1]}" if sents else "" for sents in sents_batch], add_special_tokens=False
+        )["input_ids"]
+
+        features = {key: [] for key in ["tokens", "sent_lengths", "first_tokens", "first_lengths", "last_tokens",
+            "permutation", "length"]}
+        start = 0
+
+        for sents, last_span in zip(sents_batch, last_spans):
+            end = start + len(sents)
+            sent_lengths = [len(span) for span in spans[start:end]]
+            first_lengths = [len(span) for span in first_spans[start:end]]
+            # fixed permutation for evaluation, a new permutation is sampled for training in each epoch
+            permutation = np.random.permutation(len(sents)).tolist()
+
+            features["tokens"].append([idx for span in spans[start:end] for idx in span])
+            features["sent_lengths"].append(sent_lengths)
+            features["first_tokens"].append([idx for span in first_spans[start:end] for idx in span])
+            features["first_lengths"].append(first_lengths)
+            features["last_tokens"].append(last_span)
+            features["permutation"].append(permutation)
+
+            n = len(sents)
+            first = permutation[0] if n else None
+            encoder_length = sum(sent_lengths) + (first_lengths[first] - sent_lengths[first] if n else 0) + 2 * n + 2
+            decoder_length = sum(sent_lengths[:-1]) + len(last_span) + len(self.decoder_prefix) + 2 * n + 2
+            features["length"].append(min(max(encoder_length, decoder_length), self.args.max_length))
+            start = end
+
+        if sents_batch and sents_batch[0]:
+            self._check_example(sents_batch[0], {key: np.array(values[0]) for key, values in features.items()})
+
+        return features
+
+    def _check_example(self, sents, x):
+        """
+        Check that the example assembled from the token spans is the same as the tokenized joined text.
+        """
         bos = self.tokenizer.bos_token
         eos = self.tokenizer.eos_token
 
-        sents_batch = example_batch["sents"]
-        shuffled_sents_batch = []
-        labels_batch = []
+        encoder, decoder, _, _ = self._build_example(x, x["permutation"])
+        shuffled_sents = [sents[i] for i in x["permutation"]]
 
-        for sents in sents_batch:
-            permutation = np.random.permutation(len(sents))
-            shuffled_sents = np.array(sents)[permutation].tolist()
-            shuffled_sents_batch.append(shuffled_sents)
-            labels_batch.append(np.argsort(permutation).tolist())
+        assert encoder.tolist() == self.tokenizer(
+            f" {eos}{bos} ".join(shuffled_sents) + f" {eos}{bos}", max_length=self.args.max_length, truncation=True
+        )["input_ids"], "Encoder input assembled from the token spans differs from the tokenized text"
+        assert decoder.tolist() == self.tokenizer(
+            f" {eos}{bos} " + f" {eos}{bos} ".join(sents), max_length=self.args.max_length, truncation=True
+        )["input_ids"], "Decoder input assembled from the token spans differs from the tokenized text"
 
-        encoder = [f" {eos}{bos} ".join(sentences) + f" {eos}{bos}" for sentences in shuffled_sents_batch]
-        decoder = [f" {eos}{bos} " + f" {eos}{bos} ".join(sentences) for sentences in sents_batch]
-        labels = [label + [len(label)] for label in labels_batch]
+    def _build_example(self, x, permutation, seps=None):
+        """
+        Build the encoder input (shuffled sentences), the decoder input (sentences in the original order)
+        and the pointer labels for a single example with the token spans `x`. If `seps` are given, the labels
+        for the aggregation head are also built (otherwise None is returned).
+        """
+        bos = self.tokenizer.bos_token_id
+        eos = self.tokenizer.eos_token_id
+        sent_lengths = x["sent_lengths"]
+        n = len(sent_lengths)
+
+        spans = np.split(x["tokens"], np.cumsum(sent_lengths)[:-1])
+        first_spans = np.split(x["first_tokens"], np.cumsum(x["first_lengths"])[:-1])
+        sep = [eos, bos]
+
+        # <s> s_p1 </s><s> s_p2 </s><s> ... s_pn </s><s></s>
+        encoder = [[bos]]
+        for i, k in enumerate(permutation):
+            encoder += [first_spans[k] if i == 0 else spans[k], sep]
+        encoder = np.concatenate(encoder + [[eos]]).astype(np.int64)
+
+        # <s></s><s> s_1 </s><s> s_2 ... </s><s> s_n </s>
+        decoder = [[bos], self.decoder_prefix, sep]
+        for k in range(n - 1):
+            decoder += [spans[k], sep]
+        decoder = np.concatenate(decoder + [x["last_tokens"], [eos]]).astype(np.int64)
+
+        agg_labels = None
+
+        if seps is not None:
+            # the eos following the k-th sentence in the decoder predicts the separator after the sentence
+            agg_labels = np.full(len(decoder), -100)
+            agg_labels[np.flatnonzero(decoder == eos)[1:n]] = seps[:n - 1]
+
+        max_length = self.args.max_length
+
+        if len(encoder) > max_length or len(decoder) > max_length:
+            # truncated the same way as by the tokenizer
+            encoder = np.append(encoder[:max_length - 1], eos)
+            decoder = np.append(decoder[:max_length - 1], eos)
+
+            if agg_labels is not None:
+                agg_labels = np.append(agg_labels[:max_length - 1], -100)
+
+        # the k-th eos in the decoder points to the eos following the k-th sentence in the encoder
+        # (the last one points to the final eos). In a truncated encoder, the eos appended by the truncation
+        # closes the partially kept sentence and is its target, the pointers to the cut sentences are ignored
+        # Default labels is -100 to ignore index (See https://pytorch.org/docs/stable/nn.html#crossentropyloss)
+        enc_eos = np.flatnonzero(encoder == eos)
+        dec_eos = np.flatnonzero(decoder == eos)[:n + 1]
+        targets = np.append(np.argsort(permutation), n)[:len(dec_eos)]
+        found = targets < len(enc_eos)
 
-        encoder_inputs = self.tokenizer(
-            encoder,
-            max_length=self.args.max_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
-        )
-        decoder_inputs = self.tokenizer(
-            decoder,
-            max_length=self.args.max_length,
-            padding="max_length",
-            truncation=True,
-            return_tensors="pt",
-        )
+        labels = np.full(len(decoder), -100)
+        labels[dec_eos[found]] = enc_eos[targets[found]]
+
+        return encoder, decoder, labels, agg_labels
+
+    def _collate(self, batch, shuffle):
+        """
+        Assemble the ordering examples (with a new random permutation of sentences if `shuffle` is set)
+        and pad them to the longest example in the batch.
+        """
+        examples = []
 
-        encoder_sequence_idx = [
-            ((ids == self.tokenizer.eos_token_id).nonzero()).squeeze().tolist() for ids in encoder_inputs["input_ids"]
-        ]
-        decoder_sequence_idx = [
-            ((ids == self.tokenizer.eos_token_id).nonzero()).squeeze().tolist() for ids in decoder_inputs["input_ids"]
-        ]
+        for x in batch:
+            x = {key: value.astype(np.int64) for key, value in x.items()}
 
-        assert len(encoder_sequence_idx) == len(decoder_sequence_idx)
+            if shuffle:
+                # torch RNG is seeded differently in each worker and epoch
+                permutation = torch.randperm(len(x["sent_lengths"])).numpy()
+            else:
+                permutation = x["permutation"]
 
-        bsz = len(labels)
-        # Default labels is -100 to ignore index (See https://pytorch.org/docs/stable/nn.html#crossentropyloss)
-        extend_labels = torch.ones((bsz, self.args.max_length), dtype=torch.long) * -100
-        for b_idx in range(bsz):
-            i = 0
-            for d_idx in decoder_sequence_idx[b_idx]:
-                try:
-                    extend_labels[b_idx, d_idx] = encoder_sequence_idx[b_idx][labels[b_idx][i]]
-                except:
-                    pass
-                i += 1
-        
-        encodings = {
-            "input_ids": encoder_inputs["input_ids"].tolist(),
-            "attention_mask": encoder_inputs["attention_mask"].tolist(),
-            "decoder_input_ids": decoder_inputs["input_ids"].tolist(),
-            "decoder_attention_mask": decoder_inputs["attention_mask"].tolist(),
-            "labels": extend_labels.tolist(),
-        }
-        return encodings
+            encoder, decoder, labels, agg_labels = self._build_example(
+                x, permutation, x["sep"] if self.aggregation else None
+            )
+            example = {
+                "input_ids": torch.from_numpy(encoder),
+                "attention_mask": torch.ones(len(encoder), dtype=torch.long),
+                "decoder_input_ids": torch.from_numpy(decoder),
+                "decoder_attention_mask": torch.ones(len(decoder), dtype=torch.long),
+                "labels": torch.from_numpy(labels),
+            }
+            if agg_labels is not None:
+                example["agg_labels"] = torch.from_numpy(agg_labels)
+
+            examples.append(example)
+
+        return self._pad_sequence(examples)
+
+
+
+class OrdAggDataModule(OrdDataModule):
+    """
+    DataModule for the multi-task ordering + aggregation module
+    """
+    def __init__(self, args, model_name=None):
+        super().__init__(args, model_name)
+        self.aggregation = True
 
 
 
@@ -293,6 +480,26 @@ class AggDataModule(D2TDataModule):
 
 
 
+def pc_input_text(sents, seps=None):
+    """
+    Input text for the PC model: the sentences joined with spaces, with the "<sep>" token inserted
+    between the sentences where `seps` is 1 (the aggregation in the dataset).
+    """
+    if isinstance(sents, str):
+        return sents
+
+    if not seps:
+        return " ".join(sents)
+
+    example = [sents[0]]
+    for sep, sent in zip(seps, sents[1:]):
+        if sep == 1:
+            example.append("<sep>")
+        example.append(sent)
+
+    return " ".join(example)
+
+
 class PCDataModule(D2TDataModule):
     """
     DataModule for the PC module
@@ -303,19 +510,7 @@ class PCDataModule(D2TDataModule):
     def _convert_to_features(self, example_batch, indices=None):
 
         if "sep" in example_batch:
-            seps_all = example_batch["sep"]
-            sents_all = example_batch["sents"]
-            out = []
-
-            for sents, seps in zip(sents_all, seps_all):
-                example = [sents[0]]
-                for sep, sent in zip(seps, sents[1:]):
-                    if sep == 1:
-                        example.append("<sep>")
-                    example.append(sent)
-
-                text = " ".join(example)
-                out.append(text)
+            out = [pc_input_text(sents, seps) for sents, seps in zip(example_batch["sents"], example_batch["sep"])]
 
             features = self.tokenizer(
                         out,
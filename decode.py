@@ -10,6 +10,7 @@ import torch
 import pytorch_lightning as pl
 
 from utils.tokenizer import Tokenizer
+from utils.streaming import OrderedWriter, ResumableWriter
 from inference import (
     PCInferenceModule
 )
@@ -56,8 +57,30 @@ def parse_args(args=None):
         help="Beam size used for decoding.")
     parser.add_argument("--max_length", type=int, default=1024,
         help="Maximum number of tokens per example")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"],
+        help="Apply dynamic quantization to the Linear layers of the model for CPU inference. The quantized model \
+            is saved next to the checkpoint and loaded in the next runs.")
     parser.add_argument("--test_suffix", type=str, default="",
         help="Test file suffix (e.g. _seen)")
+    parser.add_argument("--workers", type=int, default=1,
+        help="Number of processes decoding contiguous shards of the inputs on CPU, each with max_threads / workers \
+            threads. The processes are forked and share the model weights, the output is the same as with a single process.")
+    parser.add_argument("--draft_length", type=int, default=0,
+        help="Speed up the greedy decoding by verifying drafts of up to this number of tokens copied from the input \
+            in a single decoder pass (0 = disabled). The output is the same as without the drafts.")
+    parser.add_argument("--draft_ngram_size", type=int, default=2,
+        help="Number of the last output tokens matched in the input to find the draft.")
+    parser.add_argument("--cache_size", type=int, default=0,
+        help="Number of outputs kept in the in-memory cache keyed on the input (0 = disabled). \
+            Identical inputs are decoded only once in any case.")
+    parser.add_argument("--cache_dir", type=str, default=None,
+        help="Directory for the on-disk cache of outputs, persistent across runs (default = no on-disk cache).")
+    parser.add_argument("--resume", action="store_true",
+        help="Write the outputs to a journal <out_filename>.partial synced to the disk periodically and skip the examples \
+            already in the journal if the previous run was interrupted. The output file is written at the end. \
+            With --workers, the outputs are written when the workers finish.")
+    parser.add_argument("--sync_every", type=int, default=100,
+        help="Number of outputs after which the journal is synced to the disk (with --resume).")
 
 
     return parser.parse_args(args)
@@ -69,12 +92,14 @@ if __name__ == "__main__":
 
     logger.info(args)
 
+    if args.workers > 1 and args.gpus:
+        raise ValueError("Decoding with multiple workers is supported only on CPU (--gpus 0).")
+
     torch.manual_seed(args.seed)
     np.random.seed(args.seed)
     torch.set_num_threads(args.max_threads)
 
     model_path = os.path.join(args.exp_dir, args.experiment, args.checkpoint)
-    out_path = os.path.join(args.exp_dir, args.experiment, f"{args.split}.out")
 
     di = PCInferenceModule(args, model_path=model_path)
 
@@ -91,17 +116,22 @@ if __name__ == "__main__":
     trainer = pl.Trainer.from_argparse_args(args)
 
     out_filename = args.out_filename or f"{args.split}.out"
-    out_file_handle = open(os.path.join(args.exp_dir, args.experiment, out_filename), "w")
+    out_path = os.path.join(args.exp_dir, args.experiment, out_filename)
+
+    if args.resume:
+        out_file_handle = ResumableWriter(out_path, sync_every=args.sync_every)
+        logger.info(f"Resuming decoding, {len(out_file_handle.completed)} outputs completed")
+    else:
+        out_file_handle = OrderedWriter(open(out_path, "w"))
 
-    di.model.out_file_handle = out_file_handle
     di.model.tokenizer = dm.tokenizer
     di.model.beam_size_decode = args.beam_size
 
-    dataloader_map = {
-        "dev" : dm.val_dataloader,
-        "test" : dm.test_dataloader
-    }
-
-    trainer.test(test_dataloaders=dataloader_map[args.split](), model=di.model)
+    # unique inputs are decoded in batches sorted by length, the outputs are written in the original order
+    di.decode_dataset(trainer, dm, args.split, out_file_handle,
+        beam_size=args.beam_size,
+        workers=args.workers,
+        seed=args.seed
+    )
 
-    out_file_handle.close()
+    out_file_handle.close(len(dm.dataset[args.split]))
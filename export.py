@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import torch
+import torch.nn as nn
+
+from model import (
+    OrdTrainingModule,
+    AggTrainingModule,
+    PCTrainingModule,
+)
+from runtime import flatten_past, unflatten_past, load_exported
+from dataloader import pc_input_text
+from utils.streaming import chunks, read_examples
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+class Encoder(nn.Module):
+    def __init__(self, encoder):
+        super().__init__()
+        self.encoder = encoder
+
+    def forward(self, input_ids, attention_mask):
+        return self.encoder(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+class Decoder(nn.Module):
+    """
+    Decoder step returning the output of `head` for the decoder hidden states and the flattened cache.
+    """
+    def __init__(self, decoder, head):
+        super().__init__()
+        self.decoder = decoder
+        self.head = head
+
+    def forward(self, decoder_input_ids, encoder_hidden_states, encoder_attention_mask, *past):
+        outputs = self.decoder(
+            input_ids=decoder_input_ids,
+            encoder_hidden_states=encoder_hidden_states,
+            encoder_attention_mask=encoder_attention_mask,
+            past_key_values=unflatten_past(past) if past else None,
+            use_cache=True,
+            return_dict=False,
+        )
+        return (self.head(outputs[0]),) + flatten_past(outputs[1])
+
+
+class LMHead(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.lm_head = model.lm_head
+        self.register_buffer("final_logits_bias", model.final_logits_bias)
+
+    def forward(self, hidden_states):
+        return self.lm_head(hidden_states) + self.final_logits_bias
+
+
+class PointerQuery(nn.Module):
+    def __init__(self, pointer):
+        super().__init__()
+        self.q_proj = pointer.q_proj
+        self.scaling = pointer.scaling
+
+    def forward(self, hidden_states):
+        return self.q_proj(hidden_states) * self.scaling
+
+
+class Classifier(nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask):
+        return self.model(input_ids=input_ids, attention_mask=attention_mask, return_dict=False)[0]
+
+
+def trace(module, example_inputs, out_dir, name):
+    graph = torch.jit.trace(module, example_inputs)
+    graph.save(os.path.join(out_dir, f"{name}.pt"))
+    logger.info(f"Exported {name}")
+
+    return graph
+
+
+def export_seq2seq(encoder, decoder, head, out_dir, decoder_start_ids):
+    """
+    Export the encoder and the decoder step without / with the cache. The decoder graphs are traced with
+    the number of decoder input tokens used in the first / following steps.
+    """
+    input_ids = torch.tensor([[0, 10, 11, 12, 2, 0, 13, 2, 1], [0, 14, 15, 2, 0, 16, 2, 1, 1]])
+    attention_mask = (input_ids != 1).long()
+
+    encoder_hidden_states = trace(Encoder(encoder), (input_ids, attention_mask), out_dir, "encoder")(input_ids, attention_mask)
+
+    decoder_module = Decoder(decoder, head)
+    decoder_input_ids = torch.tensor([decoder_start_ids] * input_ids.size(0))
+    outputs = trace(decoder_module, (decoder_input_ids, encoder_hidden_states, attention_mask), out_dir, "decoder_init")(
+        decoder_input_ids, encoder_hidden_states, attention_mask
+    )
+    trace(decoder_module, (decoder_input_ids, encoder_hidden_states, attention_mask, *outputs[1:]), out_dir, "decoder_with_past")
+
+
+def export_model(model, module, out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+
+    with torch.no_grad():
+        if module == "pc":
+            export_seq2seq(model.model.get_encoder(), model.model.get_decoder(), LMHead(model.model), out_dir,
+                decoder_start_ids=[model.model.config.decoder_start_token_id])
+        elif module == "ord":
+            export_seq2seq(model.model.get_encoder(), model.model.get_decoder(), PointerQuery(model.pointer), out_dir,
+                decoder_start_ids=[0, 2])
+            hidden_states = torch.randn(2, 3, model.model.config.d_model)
+            trace(model.pointer.k_proj, (hidden_states,), out_dir, "pointer_keys")
+        elif module == "agg":
+            input_ids = torch.tensor([[0, 10, 11, 2, 12, 2], [0, 13, 2, 1, 1, 1]])
+            trace(Classifier(model.model), (input_ids, (input_ids != 1).long()), out_dir, "classifier")
+
+    model.tokenizer.save_pretrained(out_dir)
+    model.model.config.save_pretrained(out_dir)
+
+    with open(os.path.join(out_dir, "export.json"), "w") as f:
+        json.dump({"module": module}, f)
+
+
+def check_pc(model, exported, examples, args):
+    identical = 0
+
+    for batch in chunks(examples, args.batch_size):
+        inputs = exported.tokenizer(
+            [pc_input_text(example["sents"], example.get("sep")) for example in batch],
+            max_length=args.max_length,
+            truncation=True,
+            padding=True,
+            return_tensors="pt"
+        )
+        reference = model.model.generate(inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            max_length=args.max_length,
+            num_beams=1
+        )
+        output = exported.generate(inputs["input_ids"], inputs["attention_mask"], max_length=args.max_length)
+
+        for ref, out in zip(reference.tolist(), output.tolist()):
+            identical += [t for t in ref if t != model.tokenizer.pad_token_id] == [t for t in out if t != model.tokenizer.pad_token_id]
+
+    return identical
+
+
+def check_agg(model, exported, examples, args):
+    identical = 0
+
+    for batch in chunks(examples, args.batch_size):
+        sents_batch = [example["sents"] for example in batch]
+        text = [f" {exported.tokenizer.sep_token} ".join(sents) for sents in sents_batch]
+        inputs = exported.tokenizer(text, max_length=args.max_length, truncation=True, padding=True, return_tensors="pt")
+
+        logits = model.model(input_ids=inputs["input_ids"], attention_mask=inputs["attention_mask"])["logits"]
+        logits_exported = exported.classifier(inputs["input_ids"], inputs["attention_mask"])
+        mask = inputs["attention_mask"].bool()
+        logger.info(f"Max. logits difference: {(logits - logits_exported)[mask].abs().max():.2e}")
+
+        identical += sum(ref == out for ref, out in zip(
+            [preds.tolist() for preds in torch.argmax(logits, axis=2)],
+            [preds.tolist() for preds in torch.argmax(logits_exported, axis=2)]
+        ))
+
+    return identical
+
+
+def check_ord(model, exported, examples, args):
+    identical = 0
+
+    for batch in chunks(examples, args.batch_size):
+        inputs = exported.tokenizer(
+            [exported._join_sequences(example["sents"]) for example in batch],
+            max_length=args.max_length,
+            truncation=True,
+            padding=True,
+            return_tensors="pt"
+        )
+        order_args = dict(
+            input_ids=inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            decoder_start_token_ids=[0, 2],
+            num_beams=args.beam_size,
+            sentence_level=True,
+        )
+        identical += sum(ref == out for ref, out in zip(model.order(**order_args), exported.order(**order_args)))
+
+    return identical
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exp_dir", default="experiments", type=str,
+        help="Base directory of the experiment.")
+    parser.add_argument("--experiment", type=str, required=True,
+        help="Experiment name.")
+    parser.add_argument("--checkpoint", type=str, default="model.ckpt",
+        help="Override the default checkpoint name 'model.ckpt'.")
+    parser.add_argument("--module", type=str, required=True, choices=["pc", "ord", "agg"],
+        help="Pipeline module: pc (applies to all variants) / ord / agg")
+    parser.add_argument("--out_dir", type=str, default=None,
+        help="Output directory (default = <exp_dir>/<experiment>/exported).")
+    parser.add_argument("--in_dir", type=str, default=None,
+        help="Directory with the dataset for checking the parity of the exported model with the original model \
+            (default = no check).")
+    parser.add_argument("--split", type=str, default="dev",
+        help="Dataset split used for the check.")
+    parser.add_argument("--max_examples", type=int, default=100,
+        help="Maximum number of examples used for the check.")
+    parser.add_argument("--batch_size", type=int, default=16,
+        help="Number of examples processed in a single batch.")
+    parser.add_argument("--beam_size", default=1, type=int,
+        help="Beam size (ord).")
+    parser.add_argument("--max_length", type=int, default=1024,
+        help="Maximum number of tokens per example")
+    parser.add_argument("--seed", type=int, default=42,
+        help="Random seed.")
+    args = parser.parse_args()
+
+    logger.info(args)
+
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+
+    model_path = os.path.join(args.exp_dir, args.experiment, args.checkpoint)
+    out_dir = args.out_dir or os.path.join(args.exp_dir, args.experiment, "exported")
+
+    training_module_cls, check = {
+        "pc" : (PCTrainingModule, check_pc),
+        "ord" : (OrdTrainingModule, check_ord),
+        "agg" : (AggTrainingModule, check_agg),
+    }[args.module]
+
+    model = training_module_cls.load_from_checkpoint(model_path, map_location="cpu")
+    model.freeze()
+    export_model(model, args.module, out_dir)
+
+    if args.in_dir is not None:
+        exported = load_exported(out_dir, max_length=args.max_length)
+        examples = list(read_examples(os.path.join(args.in_dir, f"{args.split}.json")))[:args.max_examples]
+        examples = [example for example in examples if args.module == "pc" or len(example["sents"]) > 1]
+
+        with torch.no_grad():
+            identical = check(model, exported, examples, args)
+
+        logger.info(f"Outputs identical with the original model: {identical}/{len(examples)}")
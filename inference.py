@@ -12,20 +12,28 @@ import torch.nn as nn
 import torch.nn.functional as F
 import random
 import nltk
+import multiprocessing
+import traceback
 
 from torch.utils.data import DataLoader, Dataset
 from data import get_dataset_class
 
 from collections import defaultdict
+from queue import Empty
 from datasets import load_dataset, dataset_dict, Dataset
 
 from model import (
     D2TTrainingModule, 
     OrdTrainingModule, 
+    OrdAggTrainingModule, 
     AggTrainingModule, 
     PCTrainingModule,
 )
 from model import add_special_tokens
+from utils.cache import TieredCache, cache_key, file_fingerprint
+from utils.generation import copy_speculative_generate
+from utils.pipeline import BatchPipeline
+from utils.streaming import chunks
 from transformers import (
     AutoConfig,
     AutoTokenizer,
@@ -36,17 +44,93 @@ PL modules used for inference (decoding / testing / interactive mode)
 """
 logger = logging.getLogger(__name__)
 
+def quantize_model(model, dtype="int8"):
+    """
+    Apply dynamic quantization to all the Linear layers of the model (including the projections in `PointerHead`).
+    Quantized models run on CPU only.
+    """
+    dtypes = {
+        "int8" : torch.qint8,
+    }
+    return torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=dtypes[dtype], inplace=True)
+
+
+def quantized_model_path(model_path, dtype="int8"):
+    return f"{model_path}.{dtype}.pt"
+
+
 class D2TInferenceModule:
     def __init__(self, args, model_path, training_module_cls):
         self.args = args
-        self.model = training_module_cls.load_from_checkpoint(model_path)
-        self.model.freeze()
+        # dynamic quantization of the Linear layers for CPU inference (None = no quantization)
+        self.quantize = getattr(args, "quantize", None)
+
+        if self.quantize:
+            self.model = self._load_quantized(model_path, training_module_cls)
+
+            if hasattr(self.args, "gpus") and self.args.gpus > 0:
+                logger.warning("Quantized models run on CPU only, not using GPU")
+                self.args.gpus = 0
+        else:
+            self.model = training_module_cls.load_from_checkpoint(model_path)
+            self.model.freeze()
 
         logger.info(f"Loaded model from {model_path}")
 
         self.model_name = self.model.model.name_or_path
         self.tokenizer = AutoTokenizer.from_pretrained(self.model_name,
                                                        use_fast=True)
+        # tokenize the next batches and post-process the previous batches in background threads
+        # while the model runs (0 = sequential processing)
+        self.pipeline = BatchPipeline(prefetch=getattr(args, "prefetch_batches", 0), name=type(self).__name__)
+
+    def _load_quantized(self, model_path, training_module_cls):
+        """
+        Load the quantized model saved next to the checkpoint, quantize the model and save it if it does not exist
+        or if the checkpoint changed. The saved model is built from its hyperparameters and config (without loading
+        the checkpoint or the pretrained weights) and the quantized weights are loaded into it.
+        """
+        quantized_path = quantized_model_path(model_path, self.quantize)
+        # a cheap check that the checkpoint did not change (instead of hashing the whole file)
+        stat = os.stat(model_path)
+        checkpoint_version = {"size": stat.st_size, "mtime": stat.st_mtime}
+
+        if os.path.exists(quantized_path):
+            saved = torch.load(quantized_path, map_location="cpu")
+
+            if isinstance(saved, dict) and saved.get("checkpoint") == checkpoint_version:
+                model = training_module_cls(saved["args"], config=saved["config"])
+                model.freeze()
+                model = quantize_model(model, self.quantize)
+                model.load_state_dict(saved["state_dict"])
+                logger.info(f"Loading quantized model from {quantized_path}")
+                return model
+
+            logger.info(f"Quantized model {quantized_path} does not match the checkpoint, regenerating")
+
+        model = training_module_cls.load_from_checkpoint(model_path, map_location="cpu")
+        model.freeze()
+        model = quantize_model(model, self.quantize)
+        torch.save({
+            "checkpoint": checkpoint_version,
+            "args": model.args,
+            "config": model.model.config,
+            "state_dict": model.state_dict(),
+        }, quantized_path)
+        logger.info(f"Saved quantized model to {quantized_path}")
+
+        return model
+
+    def _model_fingerprint(self, model_path):
+        """
+        Identify the model for the caches of outputs (the outputs of the quantized model may differ).
+        """
+        fingerprint = file_fingerprint(model_path)
+
+        if self.quantize:
+            fingerprint += f".{self.quantize}"
+
+        return fingerprint
 
     def predict(self, s, beam_size=1):
         inputs = self.tokenizer(s, return_tensors='pt')
@@ -60,35 +144,267 @@ class D2TInferenceModule:
 
         return self.generate(inputs["input_ids"], beam_size)
 
+    def predict_batch(self, texts, beam_size=1, batch_size=16):
+        """
+        Generate the outputs for a list of input texts in padded batches. Returns `beam_size` outputs
+        for each input.
+        """
+        def prepare(batch):
+            inputs = self.tokenizer(batch,
+                max_length=self.args.max_length,
+                truncation=True,
+                padding=True,
+                return_tensors="pt"
+            )
+            return inputs.to(self.model.device)
+
+        def run(inputs):
+            return self._generate(inputs["input_ids"], inputs["attention_mask"], beam_size)
+
+        outputs = []
+
+        for sentences in self.pipeline(chunks(texts, batch_size), prepare, run, finish=lambda batch, out: self._decode(out)):
+            outputs += chunks(sentences, beam_size)
+
+        return outputs
 
     def generate(self, input_ids, beam_size):
-        out = self.model.model.generate(input_ids, 
+        out = self._generate(input_ids, torch.ones_like(input_ids), beam_size)
+
+        return self._decode(out)
+
+    def _generate(self, input_ids, attention_mask, beam_size):
+        if beam_size == 1 and getattr(self.model, "draft_length", 0) > 0:
+            return copy_speculative_generate(self.model.model,
+                input_ids,
+                attention_mask=attention_mask,
+                max_length=self.args.max_length,
+                draft_length=self.model.draft_length,
+                ngram_size=self.model.draft_ngram_size
+            )
+
+        return self.model.model.generate(input_ids,
+            attention_mask=attention_mask,
             max_length=self.args.max_length,
             num_beams=beam_size,
             num_return_sequences=beam_size
         )
 
-        sentences = self.tokenizer.batch_decode(out, 
-            skip_special_tokens=True, 
+    def _decode(self, out):
+        return self.tokenizer.batch_decode(out,
+            skip_special_tokens=True,
             clean_up_tokenization_spaces=True
         )
-            
-        return sentences
 
 
 class OrdInferenceModule(D2TInferenceModule):
-    def __init__(self, args, model_path):
-        super().__init__(args, model_path=model_path, training_module_cls=OrdTrainingModule)
+    def __init__(self, args, model_path, training_module_cls=OrdTrainingModule):
+        super().__init__(args, model_path=model_path, training_module_cls=training_module_cls)
+
+        # "sentence" = call the model only at sentence boundaries, "token" = call the model for each decoded token,
+        # "pairwise" = score all pairs of sentences in a single forward pass and search for the best permutation
+        self.decoding = getattr(args, "decoding", "sentence")
+        # maximum number of sentences for which the best permutation is searched exactly in the pairwise mode
+        self.exact_search_max_sents = getattr(args, "exact_search_max_sents", 10)
+        # inputs with up to this number of sentences are ordered by scoring all the permutations (0 = disabled)
+        self.exhaustive_max_sents = getattr(args, "exhaustive_max_sents", 0)
+        # order the inputs longer than max_length hierarchically in blocks of `block_size` sentences
+        self.hierarchical = getattr(args, "hierarchical", False)
+        self.block_size = getattr(args, "block_size", 8)
+
+        # cache of the orders keyed on the multiset of input sentences (disabled if both options are unset)
+        self.cache = None
+        cache_size = getattr(args, "cache_size", 0)
+        cache_dir = getattr(args, "cache_dir", None)
+
+        if cache_size > 0 or cache_dir:
+            cache_path = os.path.join(cache_dir, "ordering.sqlite") if cache_dir else None
+            self.cache = TieredCache(max_size=cache_size, path=cache_path)
+            self.model_fingerprint = self._model_fingerprint(model_path)
 
     def __call__(self, sequences, decoder_start_token_ids=[0, 2], num_beams=1):
-        inputs = self.tokenizer(
-            f" {self.tokenizer.eos_token}{self.tokenizer.bos_token} ".join(sequences) \
-                + f" {self.tokenizer.eos_token}{self.tokenizer.bos_token}",
+        return self.order_batch([sequences],
+            batch_size=1,
+            decoder_start_token_ids=decoder_start_token_ids,
+            num_beams=num_beams
+        )[0]
+
+    def _join_sequences(self, sequences):
+        return f" {self.tokenizer.eos_token}{self.tokenizer.bos_token} ".join(sequences) \
+                + f" {self.tokenizer.eos_token}{self.tokenizer.bos_token}"
+
+    def _postprocess_order(self, output, sequences):
+        output = list(output)
+        output.remove(max(output))
+        for i in range(len(sequences)):
+            if i not in output:
+                output.append(i)
+        assert len(output) == len(sequences)
+        return output
+
+    def _cache_key(self, sequences, decoder_start_token_ids, num_beams):
+        return cache_key(
+            self.model_fingerprint,
+            self.decoding,
+            self.exact_search_max_sents,
+            self.exhaustive_max_sents,
+            self.hierarchical,
+            self.block_size,
+            self.args.max_length,
+            decoder_start_token_ids,
+            num_beams,
+            sequences
+        )
+
+    def order_batch(self, sequences_batch, batch_size=16, decoder_start_token_ids=[0, 2], num_beams=1):
+        """
+        Order a list of examples (each example is a list of sentences) in padded batches.
+        Returns the permutation of sentence indices for each example.
+        """
+        if self.cache is None:
+            return self._order_batch(sequences_batch, batch_size, decoder_start_token_ids, num_beams)
+
+        # the examples are ordered in the canonical (sorted) order of their sentences, so that the cached order
+        # does not depend on the order of the input sentences
+        canonical_idxs = [sorted(range(len(sequences)), key=lambda k: sequences[k]) for sequences in sequences_batch]
+        keys = [
+            self._cache_key([sequences[k] for k in idxs], decoder_start_token_ids, num_beams)
+            for sequences, idxs in zip(sequences_batch, canonical_idxs)
+        ]
+        canonical_outputs = {}
+        missing = {}
+
+        for i, key in enumerate(keys):
+            if key in canonical_outputs or key in missing:
+                continue
+
+            output = self.cache.get(key)
+
+            if output is None:
+                missing[key] = [sequences_batch[i][k] for k in canonical_idxs[i]]
+            else:
+                canonical_outputs[key] = output
+
+        if missing:
+            outputs = self._order_batch(list(missing.values()), batch_size, decoder_start_token_ids, num_beams)
+
+            for key, output in zip(missing.keys(), outputs):
+                canonical_outputs[key] = output
+                self.cache.put(key, output)
+
+            self.cache.flush()
+
+        # map the canonical indices back to the indices of the input sentences
+        return [[idxs[k] for k in canonical_outputs[key]] for key, idxs in zip(keys, canonical_idxs)]
+
+    def _order_batch(self, sequences_batch, batch_size, decoder_start_token_ids, num_beams):
+        if not self.hierarchical:
+            return self._order_batch_model(sequences_batch, batch_size, decoder_start_token_ids, num_beams)
+
+        return self._order_hierarchical(
+            [[[s] for s in sequences] for sequences in sequences_batch],
+            batch_size, decoder_start_token_ids, num_beams
+        )
+
+    def _sequence_lengths(self, sequences):
+        # the sentences are preceded by a space in the joined input
+        return [len(ids) for ids in self.tokenizer([" " + s for s in sequences], add_special_tokens=False)["input_ids"]]
+
+    def _split_blocks(self, lengths):
+        """
+        Split the sentences into blocks of consecutive sentences with up to `block_size` sentences
+        fitting into max_length.
+        """
+        blocks = [[]]
+        block_length = 2
+
+        for i, length in enumerate(lengths):
+            if blocks[-1] and (len(blocks[-1]) == self.block_size or block_length + length + 2 > self.args.max_length):
+                blocks.append([])
+                block_length = 2
+
+            blocks[-1].append(i)
+            block_length += length + 2
+
+        return blocks
+
+    def _order_hierarchical(self, items_batch, batch_size, decoder_start_token_ids, num_beams):
+        """
+        Order the items (lists of one sentence or of the first and the last sentence of an ordered block).
+        The examples fitting into max_length are ordered directly. The items of the longer examples are split
+        into blocks, the blocks of all the examples are ordered in batches, and then the blocks of each example
+        are ordered recursively (each block is represented by its boundary sentences) and concatenated.
+        """
+        sequences_batch = [[" ".join(item) for item in items] for items in items_batch]
+        lengths_batch = [self._sequence_lengths(sequences) for sequences in sequences_batch]
+        blocks_batch = [self._split_blocks(lengths) for lengths in lengths_batch]
+        outputs = [None] * len(items_batch)
+
+        # <s> s_1 </s><s> s_2 </s><s> ... s_n </s><s></s>
+        # (examples with items longer than a block cannot be reduced, they are ordered truncated)
+        direct = [
+            i for i, lengths in enumerate(lengths_batch)
+            if sum(lengths) + 2 * len(lengths) + 2 <= self.args.max_length or len(blocks_batch[i]) == len(lengths)
+        ]
+        for i, out in zip(direct, self._order_batch_model(
+                [sequences_batch[i] for i in direct], batch_size, decoder_start_token_ids, num_beams)):
+            outputs[i] = out
+
+        idxs = [i for i in range(len(items_batch)) if outputs[i] is None]
+
+        if not idxs:
+            return outputs
+
+        blocks = [(i, block) for i in idxs for block in blocks_batch[i] if len(block) > 1]
+        block_orders = iter(self._order_batch_model(
+            [[sequences_batch[i][k] for k in block] for i, block in blocks],
+            batch_size, decoder_start_token_ids, num_beams
+        ))
+        ordered_blocks = {}
+
+        for i in idxs:
+            ordered_blocks[i] = []
+
+            for block in blocks_batch[i]:
+                order = next(block_orders) if len(block) > 1 else [0]
+                ordered_blocks[i].append([block[k] for k in order])
+
+        # the transitions between the blocks are decided by their boundary sentences
+        block_items = [
+            [[items_batch[i][block[0]][0], items_batch[i][block[-1]][-1]] if len(block) > 1
+                else items_batch[i][block[0]] for block in ordered_blocks[i]]
+            for i in idxs
+        ]
+        for i, order in zip(idxs, self._order_hierarchical(
+                block_items, batch_size, decoder_start_token_ids, num_beams)):
+            outputs[i] = [k for b in order for k in ordered_blocks[i][b]]
+
+        return outputs
+
+    def _tokenize_sequences(self, sequences_batch):
+        return self.tokenizer(
+            [self._join_sequences(sequences) for sequences in sequences_batch],
+            padding=True,
             truncation=True,
             max_length=self.args.max_length,
             return_tensors="pt",
         )
 
+    def _order_batch_model(self, sequences_batch, batch_size, decoder_start_token_ids, num_beams):
+        # sort the examples by length to minimize the padding in each batch
+        sorted_idxs = sorted(range(len(sequences_batch)), key=lambda i: -len(self._join_sequences(sequences_batch[i])))
+        outputs = [None] * len(sequences_batch)
+
+        # small inputs are ordered exactly by scoring all the permutations
+        exhaustive_idxs = [i for i in sorted_idxs if len(sequences_batch[i]) <= self.exhaustive_max_sents]
+        decoding_idxs = [i for i in sorted_idxs if len(sequences_batch[i]) > self.exhaustive_max_sents]
+
+        batches = [
+            (idxs[b:b+batch_size], exhaustive)
+            for idxs, exhaustive in [(exhaustive_idxs, True), (decoding_idxs, False)]
+            for b in range(0, len(idxs), batch_size)
+        ]
+
         # if hasattr(self.args, "gpus") and self.args.gpus > 0:
         #     self.model.cuda()
         #     for key in inputs.keys():
@@ -96,19 +412,45 @@ class OrdInferenceModule(D2TInferenceModule):
         # else:
         #     logger.warning("Not using GPU")
 
-        output = self.model.order(
-            input_ids=inputs["input_ids"],
-            attention_mask=inputs["attention_mask"],
-            decoder_start_token_ids=decoder_start_token_ids,
-            num_beams=num_beams,
-        )
-        output = output[0]
-        output.remove(max(output))
-        for i in range(len(sequences)):
-            if i not in output:
-                output.append(i)
-        assert len(output) == len(sequences)
-        return output
+        def prepare(batch):
+            batch_idxs, exhaustive = batch
+            return self._tokenize_sequences([sequences_batch[i] for i in batch_idxs]), exhaustive
+
+        def run(inputs):
+            return self._order_inputs(*inputs, decoder_start_token_ids, num_beams)
+
+        def finish(batch, output):
+            batch_idxs, _ = batch
+            return [(i, self._postprocess_order(out, sequences_batch[i])) for i, out in zip(batch_idxs, output)]
+
+        for batch_outputs in self.pipeline(batches, prepare, run, finish):
+            for i, out in batch_outputs:
+                outputs[i] = out
+
+        return outputs
+
+    def _order_inputs(self, inputs, exhaustive, decoder_start_token_ids, num_beams):
+        if exhaustive:
+            return self.model.order_exhaustive(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                decoder_start_token_ids=decoder_start_token_ids,
+            )
+        elif self.decoding == "pairwise":
+            return self.model.order_pairwise(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                decoder_start_token_ids=decoder_start_token_ids,
+                exact_max_sequences=self.exact_search_max_sents,
+            )
+        else:
+            return self.model.order(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                decoder_start_token_ids=decoder_start_token_ids,
+                num_beams=num_beams,
+                sentence_level=(self.decoding == "sentence"),
+            )
 
     def order(self, sequences, decoder_start_token_ids=[0, 2], num_beams=1):
         output = self(sequences, decoder_start_token_ids, num_beams)
@@ -135,34 +477,156 @@ class OrdInferenceModule(D2TInferenceModule):
 
 
 
+class OrdAggInferenceModule(OrdInferenceModule):
+    """
+    Inference with the multi-task ordering + aggregation model.
+    """
+    def __init__(self, args, model_path):
+        super().__init__(args, model_path=model_path, training_module_cls=OrdAggTrainingModule)
+
+    def order_aggregate_batch(self, sequences_batch, batch_size=16, decoder_start_token_ids=[0, 2], num_beams=1):
+        """
+        Order and aggregate a list of examples (each example is a list of sentences) in padded batches.
+        Returns the permutation of sentence indices and the separators between the ordered sentences
+        for each example.
+        """
+        sorted_idxs = sorted(range(len(sequences_batch)), key=lambda i: -len(self._join_sequences(sequences_batch[i])))
+        outputs = [None] * len(sequences_batch)
+
+        def run(inputs):
+            return self.model.order_and_aggregate(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                decoder_start_token_ids=decoder_start_token_ids,
+                num_beams=num_beams,
+                sentence_level=(self.decoding != "token"),
+            )
+
+        def finish(batch_idxs, output):
+            batch_outputs = []
+
+            for i, order, seps in zip(batch_idxs, *output):
+                sequences = sequences_batch[i]
+                # no separators after the truncated sentences
+                seps = seps + [0] * (len(sequences) - 1 - len(seps))
+                batch_outputs.append((i, (self._postprocess_order(order, sequences), seps)))
+
+            return batch_outputs
+
+        for batch_outputs in self.pipeline(
+                chunks(sorted_idxs, batch_size),
+                prepare=lambda batch_idxs: self._tokenize_sequences([sequences_batch[i] for i in batch_idxs]),
+                run=run,
+                finish=finish):
+            for i, out in batch_outputs:
+                outputs[i] = out
+
+        return outputs
+
+    def predict(self, s, beam_size=1):
+        sequences = nltk.sent_tokenize(s)
+
+        output, seps = self.order_aggregate_batch([sequences], batch_size=1, num_beams=beam_size)[0]
+        ordered_sequences = [sequences[idx] for idx in output]
+
+        return ordered_sequences, seps
+
+
 class AggInferenceModule(D2TInferenceModule):
     def __init__(self, args, model_path):
         super().__init__(args, model_path=model_path, training_module_cls=AggTrainingModule)
 
+        if hasattr(self.args, "gpus") and self.args.gpus > 0:
+            self.model.cuda()
+        else:
+            logger.warning("Not using GPU")
+
 
     def predict(self, sents, beam_size=1):
         if type(sents) == str:
             sents = nltk.sent_tokenize(sents)
 
-        text = f" {self.tokenizer.sep_token} ".join(sents)
+        return self.predict_batch([sents])[0]
 
-        inputs = self.tokenizer(text,
-            max_length=self.args.max_length,
-            truncation=True,
-            return_tensors='pt'
-        )
-        if hasattr(self.args, "gpus") and self.args.gpus > 0:
-            self.model.cuda()
-            for key in inputs.keys():
-                inputs[key] = inputs[key].cuda()
-        else:
-            logger.warning("Not using GPU")
 
-        logits = self.model.model.forward(inputs["input_ids"])["logits"]
-        preds = torch.argmax(logits, axis=2)
-        seps = preds[inputs["input_ids"] == self.tokenizer.sep_token_id][:-1]
+    def predict_batch(self, sents_batch):
+        """
+        Predict the separators between the sentences for a batch of examples (lists of sentences)
+        in a single padded forward pass.
+        """
+        return list(self.predict_batches([sents_batch]))[0]
 
-        return seps.tolist()
+    def predict_batches(self, sents_batches):
+        """
+        Predict the separators for an iterable of batches, yields the predictions for each batch
+        (see `predict_batch`). The batches may be empty.
+        """
+        def prepare(sents_batch):
+            if not sents_batch:
+                return None
+
+            text = [f" {self.tokenizer.sep_token} ".join(sents) for sents in sents_batch]
+
+            return self.tokenizer(text,
+                max_length=self.args.max_length,
+                truncation=True,
+                padding=True,
+                return_tensors='pt'
+            ).to(self.model.device)
+
+        def run(inputs):
+            if inputs is None:
+                return None
+
+            logits = self.model.model.forward(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"]
+            )["logits"]
+
+            return inputs["input_ids"], torch.argmax(logits, axis=2)
+
+        def finish(sents_batch, output):
+            if output is None:
+                return []
+
+            input_ids, preds = output
+            # predictions at the separators of each example, the last separator is the eos token
+            sep_mask = input_ids == self.tokenizer.sep_token_id
+            seps = torch.split(preds[sep_mask], sep_mask.sum(-1).tolist())
+
+            return [s[:-1].tolist() for s in seps]
+
+        yield from self.pipeline(sents_batches, prepare, run, finish)
+
+
+class _DedupWriter:
+    """
+    Writer for the outputs of the unique inputs (the interface of `OrderedWriter`): writes each output
+    for all the examples with the same input and stores it in the cache.
+    """
+    def __init__(self, writer, example_idxs, keys, cache):
+        self.writer = writer
+        self.example_idxs = example_idxs
+        self.keys = keys
+        self.cache = cache
+
+    def write(self, text, idx):
+        for i in self.example_idxs[idx]:
+            self.writer.write(text, idx=i)
+
+        if self.cache is not None:
+            self.cache.put(self.keys[idx], text)
+
+
+class _ShardWriter:
+    """
+    Collects the outputs of a decoding worker (the interface of `OrderedWriter`).
+    """
+    def __init__(self):
+        self.outputs = {}
+
+    def write(self, text, idx):
+        self.outputs[idx] = text
 
 
 class PCInferenceModule(D2TInferenceModule):
@@ -170,3 +634,151 @@ class PCInferenceModule(D2TInferenceModule):
         super().__init__(args, model_path=model_path, training_module_cls=PCTrainingModule)
 
         add_special_tokens(self.tokenizer, None)
+
+        # greedy decoding with drafts of up to `draft_length` tokens copied from the input after a matching n-gram
+        # (0 = disabled), the output is the same as without the drafts
+        self.model.draft_length = getattr(args, "draft_length", 0)
+        self.model.draft_ngram_size = getattr(args, "draft_ngram_size", 2)
+
+        # cache of the outputs keyed on the input (disabled if both options are unset)
+        self.cache = None
+        self.model_fingerprint = None
+        cache_size = getattr(args, "cache_size", 0)
+        cache_dir = getattr(args, "cache_dir", None)
+
+        if cache_size > 0 or cache_dir:
+            cache_path = os.path.join(cache_dir, "pc.sqlite") if cache_dir else None
+            self.cache = TieredCache(max_size=cache_size, path=cache_path)
+            self.model_fingerprint = self._model_fingerprint(model_path)
+
+    def _cache_key(self, input_ids, beam_size):
+        return cache_key(
+            self.model_fingerprint,
+            self.args.max_length,
+            beam_size,
+            input_ids
+        )
+
+    def decode_dataset(self, trainer, data_module, split, out_file_handle, beam_size=1, workers=1, seed=42):
+        """
+        Decode the split of the data module and write the outputs to `out_file_handle` (an `OrderedWriter`
+        or a `ResumableWriter`). Identical inputs are decoded only once and the outputs found in the cache
+        or completed in the previous run (`ResumableWriter`) are not decoded again.
+        With `workers` > 1, the inputs are split into contiguous shards decoded in forked processes (CPU only).
+        """
+        dataset = data_module.dataset[split]
+
+        with dataset.formatted_as(type=None, columns=["input_ids"]):
+            keys = [self._cache_key(ids, beam_size) for ids in dataset["input_ids"]]
+
+        example_idxs = defaultdict(list)
+
+        for i, key in enumerate(keys):
+            example_idxs[key].append(i)
+
+        to_decode = []
+        completed = getattr(out_file_handle, "completed", set())
+
+        for key, idxs in example_idxs.items():
+            resumed = [i for i in idxs if i in completed]
+
+            if resumed:
+                output = out_file_handle.read(resumed[0])
+            else:
+                output = self.cache.get(key) if self.cache is not None else None
+
+            if output is None:
+                to_decode.append(idxs[0])
+            else:
+                for i in idxs:
+                    out_file_handle.write(output, idx=i)
+
+        logger.info(f"Decoding {len(to_decode)} unique inputs ({len(keys)} examples, "
+            f"{len(example_idxs) - len(to_decode)} cached)")
+
+        if to_decode:
+            writer = _DedupWriter(out_file_handle,
+                example_idxs=[example_idxs[keys[i]] for i in to_decode],
+                keys=[keys[i] for i in to_decode],
+                cache=self.cache
+            )
+            if workers > 1:
+                for idx, text in self._decode_parallel(trainer, data_module, split, to_decode, workers, seed):
+                    writer.write(text, idx=idx)
+            else:
+                self.model.out_file_handle = writer
+                trainer.test(test_dataloaders=data_module.decode_dataloader(split, to_decode), model=self.model)
+
+        if self.cache is not None:
+            self.cache.flush()
+
+    def _decode_worker(self, trainer, data_module, split, idxs, threads, seed, queue, shard):
+        try:
+            # the same seed in all the workers, the outputs do not depend on the sharding
+            torch.set_num_threads(threads)
+            torch.manual_seed(seed)
+            np.random.seed(seed)
+            # no dataloader subprocesses in the workers
+            data_module.args.max_threads = 0
+
+            writer = _ShardWriter()
+            self.model.out_file_handle = writer
+            trainer.test(test_dataloaders=data_module.decode_dataloader(split, idxs), model=self.model)
+            queue.put((shard, writer.outputs))
+        except Exception:
+            queue.put((shard, traceback.format_exc()))
+
+    def _decode_parallel(self, trainer, data_module, split, idxs, workers, seed):
+        """
+        Decode the examples `idxs` in `workers` forked processes sharing the model weights, each with
+        an equal share of the threads. Yields (position in `idxs`, output) pairs.
+        """
+        ctx = multiprocessing.get_context("fork")
+        queue = ctx.Queue()
+        threads = max(1, torch.get_num_threads() // workers)
+        shards = [shard.tolist() for shard in np.array_split(np.arange(len(idxs)), workers) if len(shard)]
+
+        logger.info(f"Decoding in {len(shards)} workers with {threads} threads each")
+
+        processes = [
+            ctx.Process(target=self._decode_worker,
+                args=(trainer, data_module, split, [idxs[j] for j in shard], threads, seed, queue, k))
+            for k, shard in enumerate(shards)
+        ]
+        for process in processes:
+            process.start()
+
+        results = {}
+
+        try:
+            while len(results) < len(shards):
+                # the workers which exited before the wait, a worker flushes its outputs to the queue before exiting
+                exited = [k for k, process in enumerate(processes) if k not in results and process.exitcode is not None]
+
+                try:
+                    k, outputs = queue.get(timeout=10)
+                except Empty:
+                    if exited:
+                        # e.g. killed by the OOM killer
+                        raise RuntimeError(f"Decoding worker {exited[0]} exited with code "
+                            f"{processes[exited[0]].exitcode} without sending its outputs")
+                    continue
+
+                if isinstance(outputs, str):
+                    raise RuntimeError(f"Decoding worker {k} failed:\n{outputs}")
+
+                results[k] = outputs
+        except BaseException:
+            for process in processes:
+                process.terminate()
+            raise
+
+        for k, process in enumerate(processes):
+            process.join()
+
+            if process.exitcode != 0:
+                raise RuntimeError(f"Decoding worker {k} exited with code {process.exitcode}")
+
+        for k, shard in enumerate(shards):
+            for pos, j in enumerate(shard):
+                yield j, results[k][pos]
@@ -14,6 +14,7 @@ from utils.tokenizer import Tokenizer
 from inference import (
     D2TInferenceModule, 
     OrdInferenceModule, 
+    OrdAggInferenceModule,
     AggInferenceModule,
     PCInferenceModule
 )
@@ -28,7 +29,7 @@ if __name__ == "__main__":
     parser.add_argument("--experiment", type=str, required=True,
         help="Experiment name. Refers to a folder in `exp_dir`.")
     parser.add_argument("--module", required=True,
-        help="Pipeline module: pc (applies to all variants) / agg / ord")
+        help="Pipeline module: pc (applies to all variants) / agg / ord / ord_agg")
     parser.add_argument("--seed", default=42, type=int,
         help="Random seed.")
     parser.add_argument("--max_threads", default=8, type=int,
@@ -39,6 +40,9 @@ if __name__ == "__main__":
         help="Number of GPUs.")
     parser.add_argument("--max_length", type=int, default=1024,
         help="Maximum number of tokens per example")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"],
+        help="Apply dynamic quantization to the Linear layers of the model for CPU inference. The quantized model \
+            is saved next to the checkpoint and loaded in the next runs.")
     parser.add_argument("--checkpoint", type=str, default="model.ckpt",
         help="Override the default checkpoint name 'model.ckpt'.")
     args = parser.parse_args()
@@ -54,12 +58,14 @@ if __name__ == "__main__":
     # works like this for convenience, feel free to override
     if args.module == "ord":
         inference_module_cls = OrdInferenceModule
+    elif args.module == "ord_agg":
+        inference_module_cls = OrdAggInferenceModule
     elif args.module == "agg":
         inference_module_cls = AggInferenceModule
     elif args.module == "pc":
         inference_module_cls = PCInferenceModule
     else:
-        logger.error(f"Module not recognized: {args.module}. Use one of: {{pc,agg,ord}}.")
+        logger.error(f"Module not recognized: {args.module}. Use one of: {{pc,agg,ord,ord_agg}}.")
 
     dm = inference_module_cls(args, model_path=model_path)
     logger.info(f"Using {inference_module_cls}")
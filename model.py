@@ -15,6 +15,7 @@ If you use the ordering model, please cite also:
 }
 """
 
+import copy
 import numpy as np
 import os
 import logging
@@ -48,10 +49,25 @@ from transformers import (
 )
 from transformers.modeling_outputs import ModelOutput
 from utils.ordering_utils import OrderingMixin
+from utils.generation import copy_speculative_generate
 
 logger = logging.getLogger(__name__)
 
 
+def load_pretrained(model_cls, model_name, config=None, **kwargs):
+    """
+    Load the pretrained model `model_name`, or build the model from `config` without loading the pretrained
+    weights (the weights are loaded afterwards from a saved state dict, e.g. the quantized weights).
+    """
+    if config is None:
+        return model_cls.from_pretrained(model_name, **kwargs)
+
+    if hasattr(model_cls, "from_config"):
+        return model_cls.from_config(config)
+
+    return model_cls(config)
+
+
 def add_special_tokens(tokenizer, model):
     special_tokens_dict = {'additional_special_tokens': ['<sep>']}
     tokenizer.add_special_tokens(special_tokens_dict)
@@ -60,16 +76,102 @@ def add_special_tokens(tokenizer, model):
         model.resize_token_embeddings(len(tokenizer))
 
 
+def select_layers(num_layers, num_selected):
+    """
+    Indices of `num_selected` evenly spaced layers out of `num_layers` (including the first and the last one).
+    """
+    if not 0 < num_selected <= num_layers:
+        raise ValueError(f"Cannot select {num_selected} out of {num_layers} layers")
+
+    return np.linspace(0, num_layers - 1, num_selected).round().astype(int).tolist()
+
+
+def shrink_model(model, encoder_layers=None, decoder_layers=None):
+    """
+    Keep only `encoder_layers` / `decoder_layers` evenly spaced layers of a BART / RoBERTa model
+    (a student model for distillation). Modifies the model in place.
+    """
+    base_model = model.base_model
+
+    if hasattr(base_model, "decoder"):
+        stacks = [(base_model.encoder, "layers", "encoder_layers", encoder_layers),
+                  (base_model.decoder, "layers", "decoder_layers", decoder_layers)]
+    else:
+        if decoder_layers:
+            raise ValueError(f"{type(model).__name__} does not have a decoder")
+
+        stacks = [(base_model.encoder, "layer", "num_hidden_layers", encoder_layers)]
+
+    for stack, layers_attr, config_attr, num_selected in stacks:
+        if not num_selected:
+            continue
+
+        layers = getattr(stack, layers_attr)
+        setattr(stack, layers_attr, nn.ModuleList([layers[i] for i in select_layers(len(layers), num_selected)]))
+        setattr(model.config, config_attr, num_selected)
+
+    return model
+
+
 class D2TTrainingModule(pl.LightningModule):
+    # model outputs matched with the teacher outputs in distillation and the labels marking the valid positions
+    # (None = the positions where the teacher logits are not masked)
+    distilled_outputs = {"logits": "labels"}
+
     def __init__(self, args, **kwargs):
         super().__init__()
         self.args = args
-        self.save_hyperparameters(ignore=["datamodule"])
+        self.save_hyperparameters(ignore=["datamodule", "config"])
 
         self.special_tokens = None
         self.tokenizer = AutoTokenizer.from_pretrained(args.model_name,
                                                        use_fast=True)
         self.datamodule = kwargs.get("datamodule", None)
+        # teacher model for distillation (not saved in the checkpoints, see `set_teacher`)
+        self.teacher = None
+
+    def _shrink_student(self):
+        shrink_model(self.model,
+            encoder_layers=getattr(self.args, "student_encoder_layers", None),
+            decoder_layers=getattr(self.args, "student_decoder_layers", None)
+        )
+
+    def set_teacher(self, teacher, init_student=True):
+        """
+        Distill the model from `teacher` (a trained model of the same pipeline module). With `init_student` and
+        both models based on the same pretrained model, the student is initialized with the teacher weights
+        of the kept layers.
+        """
+        teacher.freeze()
+
+        if init_student and teacher.args.model_name == self.args.model_name:
+            student_model = shrink_model(copy.deepcopy(teacher.model),
+                encoder_layers=getattr(self.args, "student_encoder_layers", None),
+                decoder_layers=getattr(self.args, "student_decoder_layers", None)
+            )
+            state_dict = {k: v for k, v in teacher.state_dict().items() if not k.startswith("model.")}
+            state_dict.update({f"model.{k}": v for k, v in student_model.state_dict().items()})
+            self.load_state_dict(state_dict)
+            logger.info("Student initialized from the teacher")
+
+        self.teacher = teacher
+
+    def train(self, mode=True):
+        super().train(mode)
+
+        # the teacher is a submodule, keep its dropout disabled while the student is trained
+        if getattr(self, "teacher", None) is not None:
+            self.teacher.eval()
+
+        return self
+
+    def on_save_checkpoint(self, checkpoint):
+        # the student checkpoint is loadable without the teacher
+        checkpoint["state_dict"] = {k: v for k, v in checkpoint["state_dict"].items() if not k.startswith("teacher.")}
+
+    def on_load_checkpoint(self, checkpoint):
+        if self.teacher is not None:
+            checkpoint["state_dict"].update({f"teacher.{k}": v for k, v in self.teacher.state_dict().items()})
 
     def forward(self, **inputs):
         out = self.model(
@@ -80,12 +182,53 @@ class D2TTrainingModule(pl.LightningModule):
         return {"loss": out["loss"], "logits": out["logits"]}
 
     def training_step(self, batch, batch_idx):
+        if self.teacher is not None and getattr(self.args, "distill_pseudo_targets", False):
+            batch = self._pseudo_targets(batch)
+
         outputs = self(**batch)
         loss = outputs["loss"]
 
+        if self.teacher is not None:
+            distill_loss = self._distillation_loss(batch, outputs)
+            alpha = self.args.distill_alpha
+            loss = (1 - alpha) * loss + alpha * distill_loss
+
+            self.log('loss/distill', distill_loss)
+
         self.log('loss/train', loss, prog_bar=True)
         return loss
 
+    def _pseudo_targets(self, batch):
+        raise NotImplementedError(f"Pseudo-targets are not supported for {type(self).__name__}")
+
+    def _distillation_loss(self, batch, outputs):
+        """
+        KL divergence between the teacher and the student distributions softened with the temperature.
+        """
+        temperature = self.args.distill_temperature
+
+        with torch.no_grad():
+            teacher_outputs = self.teacher(**batch)
+
+        loss = 0
+
+        for key, labels_key in self.distilled_outputs.items():
+            teacher_logits, student_logits = teacher_outputs[key], outputs[key]
+            valid = torch.isfinite(teacher_logits)
+            positions = valid.any(-1) if labels_key is None else batch[labels_key] != -100
+
+            # the masked logits (-inf) get zero probability, the fully masked rows are skipped
+            fill_value = torch.finfo(student_logits.dtype).min
+            teacher_log_probs = F.log_softmax(teacher_logits.masked_fill(~valid, fill_value)[positions] / temperature, dim=-1)
+            student_log_probs = F.log_softmax(student_logits.masked_fill(~valid, fill_value)[positions] / temperature, dim=-1)
+
+            loss = loss + F.kl_div(student_log_probs, teacher_log_probs,
+                reduction="batchmean",
+                log_target=True
+            ) * temperature ** 2
+
+        return loss
+
     def validation_step(self, batch, batch_idx):
         outputs = self(**batch)
         loss = outputs["loss"]
@@ -95,22 +238,40 @@ class D2TTrainingModule(pl.LightningModule):
         return loss
 
     def test_step(self, batch, batch_idx):
-        out = self.model.generate(batch["input_ids"], 
-            max_length=self.args.max_length,
-            num_beams=1,
-            num_return_sequences=1)
+        # greedy decoding with drafts copied from the input (set in PCInferenceModule, 0 = disabled)
+        draft_length = getattr(self, "draft_length", 0)
+
+        if draft_length > 0:
+            out = copy_speculative_generate(self.model,
+                batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                max_length=self.args.max_length,
+                draft_length=draft_length,
+                ngram_size=self.draft_ngram_size)
+        else:
+            out = self.model.generate(batch["input_ids"], 
+                max_length=self.args.max_length,
+                num_beams=1,
+                num_return_sequences=1)
         
         out = self.tokenizer.batch_decode(out, 
             skip_special_tokens=True,
             clean_up_tokenization_spaces=True
         )
-        for idx, o in enumerate(out):
-            logger.info(f"[{batch_idx * len(out) + idx}] {o}")
-            self.out_file_handle.write(o + "\n")
+        # the batches may be sorted by length, write the outputs in the original order
+        if "example_idx" in batch:
+            example_idxs = batch["example_idx"].tolist()
+        else:
+            example_idxs = [None] * len(out)
+
+        for idx, o in zip(example_idxs, out):
+            logger.info(f"[{idx}] {o}")
+            self.out_file_handle.write(o + "\n", idx=idx)
 
     def configure_optimizers(self):
+        # including the heads on top of the model (the frozen teacher is excluded)
         optimizer = AdamW(
-            self.model.parameters(),
+            [p for p in self.parameters() if p.requires_grad],
             lr=self.args.learning_rate,
             eps=self.args.adam_epsilon,
             betas=(self.args.adam_beta1, self.args.adam_beta2)
@@ -149,6 +310,17 @@ class D2TTrainingModule(pl.LightningModule):
         parser.add_argument("--adam_beta2", default=0.997, type=float)
         parser.add_argument("--warmup_proportion", default=0.1, type=float)
         parser.add_argument("--label_smoothing", default=0.1, type=float)
+        parser.add_argument("--agg_loss_weight", default=1.0, type=float)
+        parser.add_argument("--student_encoder_layers", default=None, type=int,
+            help="Keep only this number of evenly spaced encoder layers (a smaller student model for distillation).")
+        parser.add_argument("--student_decoder_layers", default=None, type=int,
+            help="Keep only this number of evenly spaced decoder layers (a smaller student model for distillation).")
+        parser.add_argument("--distill_alpha", default=0.5, type=float,
+            help="Weight of the distillation loss (the weight of the loss on the labels is 1 - alpha).")
+        parser.add_argument("--distill_temperature", default=2.0, type=float,
+            help="Temperature of the teacher and student distributions in the distillation loss.")
+        parser.add_argument("--distill_pseudo_targets", action="store_true",
+            help="Train on the greedy outputs of the teacher instead of the references (pc only).")
 
         return parser
 
@@ -197,11 +369,24 @@ class PointerHead(nn.Module):
 
         return attn_weights
 
+    def project_keys(self, key):
+        """Input shape: Batch x SeqLen x Channel (computed once per input and reused in each decoding step)"""
+        return self.k_proj(key)
+
+    def score(self, query, projected_key):
+        """Input shape: Batch x SeqLen x Channel, returns Batch x QueryLen x KeyLen"""
+        q = self.q_proj(query) * self.scaling
+
+        return torch.bmm(q, projected_key.transpose(1, 2))
+
 
 @dataclass
 class Seq2SeqOrderingOutput(ModelOutput):
     loss: Optional[torch.FloatTensor]
     logits: torch.FloatTensor = None
+    sequence_positions: Optional[torch.LongTensor] = None
+    pointer_keys: Optional[torch.FloatTensor] = None
+    agg_logits: Optional[torch.FloatTensor] = None
     last_hidden_state: Optional[List[torch.FloatTensor]] = None
     past_key_values: Optional[List[torch.FloatTensor]] = None
     decoder_hidden_states: Optional[Tuple[torch.FloatTensor]] = None
@@ -211,14 +396,19 @@ class Seq2SeqOrderingOutput(ModelOutput):
     encoder_attentions: Optional[Tuple[torch.FloatTensor]] = None
 
 class OrdTrainingModule(D2TTrainingModule, OrderingMixin):
+    # the rows of the pointer logits for the queries not used in the loss are masked
+    distilled_outputs = {"logits": None}
+
     def __init__(self, args, **kwargs):
         super().__init__(args, **kwargs)
-        self.model = BartModel.from_pretrained(
+        self.model = load_pretrained(BartModel,
             args.model_name,
+            config=kwargs.get("config"),
             use_cache=True,
             return_dict=True
         )
         self.pointer = PointerHead(self.model.config.d_model)
+        self._shrink_student()
 
         self.eos_token_id = self.tokenizer.eos_token_id
         self.pad_token_id = self.tokenizer.pad_token_id
@@ -236,6 +426,7 @@ class OrdTrainingModule(D2TTrainingModule, OrderingMixin):
             "decoder_input_ids": decoder_input_ids,
             "attention_mask": attention_mask,
             "use_cache": use_cache,   # change this to avoid caching (presumably for debugging)
+            "pointer_keys": kwargs.get("pointer_keys"),
         }
 
     def forward(self, 
@@ -249,8 +440,18 @@ class OrdTrainingModule(D2TTrainingModule, OrderingMixin):
             use_cache=None,
             output_attentions=None,
             output_hidden_states=None,
-            return_dict=None
+            return_dict=None,
+            pointer_keys=None,
         ):
+        """
+        The pointer is computed only between the sequence representations (eos tokens): the logits have the shape
+        (bsz, decoder_len, N) for N sequences in the input (bsz, 1, N) with `use_cache`, the column j corresponds
+        to the sequence ending at `sequence_positions[:, j]`. With `labels`, the logits are computed only
+        for the eos tokens in the decoder input (bsz, M, N).
+
+        The projected keys of the sequences (`pointer_keys`) do not depend on the decoder input and can be passed
+        from the previous decoding step.
+        """
 
         if labels is not None:
             use_cache = False
@@ -270,35 +471,39 @@ class OrdTrainingModule(D2TTrainingModule, OrderingMixin):
         )
         use_cache = use_cache if use_cache is not None else self.args.use_cache
 
-        encoder_sequence_last_hidden_state = outputs.encoder_last_hidden_state
+        sequence_positions, sequence_mask = self._gather_positions(input_ids == self.eos_token_id)
+
+        if pointer_keys is None:
+            pointer_keys = self.pointer.project_keys(
+                self._gather_states(outputs.encoder_last_hidden_state, sequence_positions)
+            )
+
         decoder_sequence_last_hidden_state = outputs.last_hidden_state
 
-        encoder_sequence_attention_mask = (input_ids == self.tokenizer.eos_token_id).float()
-        if use_cache:
+        if labels is not None:
+            # only the decoder eos tokens are pointing to the next sequence
+            query_positions, query_mask = self._gather_positions(decoder_input_ids == self.eos_token_id)
+            decoder_sequence_last_hidden_state = self._gather_states(decoder_sequence_last_hidden_state, query_positions)
+        elif use_cache:
             decoder_sequence_last_hidden_state = decoder_sequence_last_hidden_state[:, -1:]
-            decoder_sequence_attention_mask = (decoder_input_ids[:, -1:] == self.eos_token_id).float()
+            query_mask = decoder_input_ids[:, -1:] == self.eos_token_id
         else:
-            decoder_sequence_attention_mask = (decoder_input_ids == self.eos_token_id).float()
-
-        sequence_attention_mask = torch.bmm(
-            decoder_sequence_attention_mask.unsqueeze(2), encoder_sequence_attention_mask.unsqueeze(1)
-        )
-
-        logits = self.pointer(
-            query=decoder_sequence_last_hidden_state.transpose(1, 0),
-            key=encoder_sequence_last_hidden_state.transpose(1, 0),
-        )
-        # logits: shape = (bsz, decoder_len, encoder_len), X_ij = probability of j to be the sentence after i
+            query_mask = decoder_input_ids == self.eos_token_id
 
+        logits = self.pointer.score(decoder_sequence_last_hidden_state, pointer_keys)
+        # logits: shape = (bsz, decoder_len, N), X_ij = probability of j to be the sentence after i
 
-        assert sequence_attention_mask.size() == logits.size(), f"{sequence_attention_mask.size()}, {logits.size()}"
-
-        logits[sequence_attention_mask == 0] = float("-inf")
+        logits = logits.masked_fill(~(query_mask.unsqueeze(-1) & sequence_mask.unsqueeze(1)), float("-inf"))
 
         loss = None
         if labels is not None:
+            # convert the labels (eos positions in the input) to the indices of the sequences
+            query_labels = labels.gather(1, query_positions).masked_fill(~query_mask, -100)
+            matches = (query_labels.unsqueeze(-1) == sequence_positions.unsqueeze(1)) & sequence_mask.unsqueeze(1)
+            sequence_labels = matches.long().argmax(-1).masked_fill(~matches.any(-1), -100)
+
             loss_fct = nn.CrossEntropyLoss()
-            loss = loss_fct(logits.view(-1, logits.size(-1)), labels.view(-1))
+            loss = loss_fct(logits.view(-1, logits.size(-1)), sequence_labels.view(-1))
 
         if return_dict:
             output = (logits,) + outputs[1:]
@@ -307,6 +512,8 @@ class OrdTrainingModule(D2TTrainingModule, OrderingMixin):
         return Seq2SeqOrderingOutput(
             loss=loss,
             logits=logits,
+            sequence_positions=sequence_positions,
+            pointer_keys=pointer_keys,
             last_hidden_state=outputs.last_hidden_state,
             past_key_values=outputs.past_key_values,
             decoder_hidden_states=outputs.decoder_hidden_states,
@@ -318,20 +525,13 @@ class OrdTrainingModule(D2TTrainingModule, OrderingMixin):
 
     @staticmethod
     def _reorder_cache(past, beam_idx):
-        ((enc_out, enc_mask), past_key_values) = past
-        reordered_past = []
-        for layer_past in past_key_values:
-            # get the correct batch idx from decoder layer's batch dim for cross and self-attn
-            layer_past_new = {
-                attn_key: _reorder_buffer(attn_cache, beam_idx) for attn_key, attn_cache in layer_past.items()
-            }
-            reordered_past.append(layer_past_new)
-
-        new_enc_out = enc_out if enc_out is None else enc_out.index_select(0, beam_idx)
-        new_enc_mask = enc_mask if enc_mask is None else enc_mask.index_select(0, beam_idx)
-
-        past = ((new_enc_out, new_enc_mask), reordered_past)
-        return past
+        reordered_past = ()
+        for layer_past in past:
+            # cached cross-attention states are the same for all the beams of an example -> no need to reorder them
+            reordered_past += (
+                tuple(past_state.index_select(0, beam_idx) for past_state in layer_past[:2]) + layer_past[2:],
+            )
+        return reordered_past
 
     def get_encoder(self):
         return self.model.encoder
@@ -346,15 +546,90 @@ class OrdTrainingModule(D2TTrainingModule, OrderingMixin):
 
 
 
+class OrdAggTrainingModule(OrdTrainingModule):
+    """
+    Ordering model with an aggregation head: the decoder state at the eos token of each ordered sentence
+    predicts whether the sentence is followed by a separator (i.e. the ordering and the aggregation
+    share a single encoder pass).
+    """
+    distilled_outputs = {"logits": None, "agg_logits": "agg_labels"}
+
+    def __init__(self, args, **kwargs):
+        super().__init__(args, **kwargs)
+        self.agg_head = nn.Linear(self.model.config.d_model, 2)
+
+    def forward(self, *args, agg_labels=None, **kwargs):
+        outputs = super().forward(*args, **kwargs)
+        agg_logits = self.agg_head(outputs.last_hidden_state)
+        loss = outputs.loss
+
+        if agg_labels is not None:
+            loss_fct = nn.CrossEntropyLoss()
+            agg_loss = loss_fct(agg_logits.view(-1, agg_logits.size(-1)), agg_labels.view(-1))
+            loss = agg_loss if loss is None else loss + getattr(self.args, "agg_loss_weight", 1.0) * agg_loss
+
+        outputs["agg_logits"] = agg_logits
+        outputs["loss"] = loss
+
+        return outputs
+
+    @torch.no_grad()
+    def order_and_aggregate(self, input_ids, attention_mask=None, decoder_start_token_ids=None, num_beams=1,
+            sentence_level=True):
+        """
+        Order the sequences in `input_ids` and predict the separators between the ordered sequences.
+        The input is encoded only once. Returns the orders (in the format of `order`, i.e. with the end marker
+        as the last item) and the separators after each ordered sequence except the last one.
+        """
+        if attention_mask is None:
+            attention_mask = input_ids.new_ones(input_ids.shape)
+
+        encoder_outputs = self.get_encoder()(input_ids, attention_mask=attention_mask)
+        orders = self.order(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            decoder_start_token_ids=decoder_start_token_ids,
+            num_beams=num_beams,
+            sentence_level=sentence_level,
+            encoder_outputs=encoder_outputs,
+        )
+        spans_batch = self._sequence_spans(input_ids)
+        permutations = []
+
+        for spans, order in zip(spans_batch, orders):
+            # move the end marker to the end, append the sequences which were not ordered
+            end = len(spans) - 1
+            order = [idx for idx in order if idx != end]
+            permutations.append(order + [idx for idx in range(end) if idx not in order] + [end])
+
+        decoder_input_ids, queries, _ = self._permuted_decoder_inputs(
+            input_ids, spans_batch, permutations, decoder_start_token_ids
+        )
+        outputs = self(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            encoder_outputs=encoder_outputs,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=False,
+        )
+        # queries[:, k + 1] = eos of the k-th ordered sequence
+        preds = outputs.agg_logits.argmax(-1).gather(1, queries)
+        seps = [row[1 : len(permutation) - 1] for row, permutation in zip(preds.tolist(), permutations)]
+
+        return permutations, seps
+
+
 class AggTrainingModule(D2TTrainingModule):
     def __init__(self, args, **kwargs):
         super().__init__(args, **kwargs)
 
-        self.model = AutoModelForTokenClassification.from_pretrained(
+        self.model = load_pretrained(AutoModelForTokenClassification,
             args.model_name,
+            config=kwargs.get("config"),
             return_dict=True,
             num_labels=2
         )
+        self._shrink_student()
 
     def test_step(self, batch, batch_idx):
         raise NotImplementedError
@@ -364,8 +639,25 @@ class PCTrainingModule(D2TTrainingModule):
     def __init__(self, args, **kwargs):
         super().__init__(args, **kwargs)
 
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(
+        self.model = load_pretrained(AutoModelForSeq2SeqLM,
             args.model_name,
+            config=kwargs.get("config"),
             return_dict=True
         )
-        add_special_tokens(self.tokenizer, self.model)
\ No newline at end of file
+        add_special_tokens(self.tokenizer, self.model)
+        self._shrink_student()
+
+    def _pseudo_targets(self, batch):
+        """
+        Replace the targets with the greedy outputs of the teacher (sequence-level distillation).
+        """
+        with torch.no_grad():
+            out = self.teacher.model.generate(batch["input_ids"],
+                attention_mask=batch["attention_mask"],
+                max_length=self.args.max_length,
+                num_beams=1
+            )
+        # skip the decoder start token
+        labels = out[:, 1:].masked_fill(out[:, 1:] == self.tokenizer.pad_token_id, -100)
+
+        return {**batch, "labels": labels}
\ No newline at end of file
@@ -6,7 +6,8 @@ import argparse
 import logging
 import numpy as np
 from model import OrdTrainingModule
-from inference import OrdInferenceModule
+from inference import OrdInferenceModule, OrdAggInferenceModule
+from utils.streaming import chunks, input_filename, read_examples, ExampleWriter, OrderedWriter, ResumableWriter
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
 logger = logging.getLogger(__name__)
@@ -15,65 +16,191 @@ logger = logging.getLogger(__name__)
 
 class D2TOrderingModule:
     def __init__(self, args, model_path):
-        self.model = OrdInferenceModule(args, model_path=model_path)
+        # insert the separators predicted by the multi-task ordering + aggregation model
+        self.aggregate = getattr(args, "aggregate", False)
+        self.separator = getattr(args, "separator", "<sep>")
 
-    def order_dataset(self, in_filename, out_filename, join_sents, shuffle=False):
-        output = {
-            "data" : []
-        }
-        with open(in_filename) as in_file:
-            j = json.load(in_file)
+        if self.aggregate:
+            self.model = OrdAggInferenceModule(args, model_path=model_path)
+        else:
+            self.model = OrdInferenceModule(args, model_path=model_path)
+        self.batch_size = args.batch_size
+        # log every n-th example (0 = no logging of examples)
+        self.log_every = getattr(args, "log_every", 1)
+        # number of examples read and ordered at once in the streaming mode
+        self.stream_chunk_size = getattr(args, "stream_chunk_size", 256)
+        # write the outputs to a journal and skip the examples completed in the previous run
+        self.resume = getattr(args, "resume", False)
+        self.sync_every = getattr(args, "sync_every", 100)
+
+    def _shuffle_examples(self, examples):
+        # the sentences of the trivial examples are not shuffled (no random draws)
+        for example in examples:
+            if len(example["sents"]) > 1:
+                np.random.shuffle(example["sents"])
+
+    def order_examples(self, examples, shuffle=False):
+        """
+        Order the sentences of all the examples in batches. Returns a permutation of sentence indices for each
+        example (None for trivial examples with a single sentence) and the separators between the ordered
+        sentences (None if not aggregating).
+        """
+        if shuffle:
+            self._shuffle_examples(examples)
+
+        to_order = [i for i, example in enumerate(examples) if len(example["sents"]) > 1]
+
+        permutations = [None] * len(examples)
+        separators = [None] * len(examples)
+
+        if self.aggregate:
+            ordered = self.model.order_aggregate_batch(
+                [examples[i]["sents"] for i in to_order],
+                batch_size=self.batch_size
+            )
+            for i, (permutation, seps) in zip(to_order, ordered):
+                permutations[i] = permutation
+                separators[i] = seps
+        else:
+            ordered = self.model.order_batch(
+                [examples[i]["sents"] for i in to_order],
+                batch_size=self.batch_size
+            )
+            for i, permutation in zip(to_order, ordered):
+                permutations[i] = permutation
+
+        if self.model.cache is not None:
+            logger.info(f"Ordering cache: {self.model.cache.hits} hits, {self.model.cache.misses} misses")
+
+        return permutations, separators
+
+    def _read_ordered(self, in_filename, shuffle, stream, completed=None):
+        """
+        Yield the examples together with their permutations and separators. In the streaming mode, the examples
+        are read and ordered in chunks, otherwise the whole dataset is loaded and ordered at once.
+        The examples with the indices in `completed` are not ordered (the permutation is None).
+        """
+        if completed is None:
+            completed = set()
+
+        if stream:
+            example_chunks = chunks(read_examples(in_filename), self.stream_chunk_size)
+        else:
+            with open(in_filename) as in_file:
+                example_chunks = [json.load(in_file)["data"]]
+
+        offset = 0
+
+        for chunk in example_chunks:
+            if shuffle:
+                # the completed examples are shuffled as well, the resumed run gets the same random draws
+                self._shuffle_examples(chunk)
+
+            to_order = [k for k in range(len(chunk)) if offset + k not in completed]
+            ordered = {}
+
+            if to_order:
+                ordered = dict(zip(to_order, zip(*self.order_examples([chunk[k] for k in to_order]))))
+
+            for k, example in enumerate(chunk):
+                yield (example, *ordered.get(k, (None, None)))
 
-            for i, example in enumerate(j["data"]):
-                passages = example["sents"]
-                if len(passages) == 1:
-                    passages_ordered = passages
-                else:
-                    if shuffle:
-                        np.random.shuffle(passages)
+            offset += len(chunk)
 
-                    passages_ordered = self.model.order(passages)
+    def _open_writer(self, out_filename, format):
+        if self.resume:
+            writer = ResumableWriter(out_filename, format=format, sync_every=self.sync_every)
+            logger.info(f"Resuming ordering, {len(writer.completed)} outputs completed")
+            return writer
 
-                logger.info(i)
-                logger.info(passages)
-                logger.info(passages_ordered)
-                logger.info("================")
+        if format == "text":
+            return OrderedWriter(open(out_filename, "w"))
 
-                if join_sents:
-                    passages_ordered = " ".join(passages_ordered)
+        return ExampleWriter(out_filename, stream=(format == "jsonl"))
 
-                example_sorted = {
-                    "sents" : passages_ordered,
-                    "text" : example["text"]
-                }
-                output["data"].append(example_sorted)
+    def _log_example(self, i, *items):
+        if self.log_every and i % self.log_every == 0:
+            logger.info(i)
+            for item in items:
+                logger.info(item)
+            logger.info("================")
 
-        with open(os.path.join(out_filename), "w") as f:
-            json.dump(output, f, indent=4, ensure_ascii=False)
+    def _insert_separators(self, passages, seps):
+        out = []
 
-    def order_dataset_indices(self, in_filename, out_filename, shuffle=False):
-        with open(in_filename) as in_file, open(os.path.join(out_filename), "w") as f:
-            j = json.load(in_file)
+        for j in range(len(passages)):
+            out.append(passages[j])
 
-            for i, example in enumerate(j["data"]):
-                passages = example["sents"]
+            if j < len(seps) and seps[j] == 1:
+                out.append(self.separator)
 
-                if len(passages) == 1:
-                    # skip trivial examples
-                    continue
+        return out
 
-                if shuffle:
-                    np.random.shuffle(passages)
+    def order_dataset(self, in_filename, out_filename, join_sents, shuffle=False, stream=False):
+        """
+        Order the sentences in the dataset. In the streaming mode, the output is written as a JSONL file
+        (one example per line) after each chunk of examples. If aggregating, the separators are inserted
+        between the ordered sentences and the sentences are joined (the input format of aggregate.py output).
+        """
+        writer = self._open_writer(out_filename, format="jsonl" if stream else "json")
+        completed = getattr(writer, "completed", set())
+        num_examples = 0
 
-                # indices = np.random.permutation(len(passages))
-                indices = self.model.order_indices(passages)
+        for i, (example, permutation, seps) in enumerate(self._read_ordered(in_filename, shuffle, stream, completed)):
+            num_examples += 1
 
-                logger.info(i)
-                logger.info(passages)
-                logger.info(indices)
-                logger.info("================")
+            if i in completed:
+                continue
 
-                f.write(" ".join([str(x) for x in indices]) + "\n")
+            passages = example["sents"]
+
+            if permutation is None:
+                passages_ordered = passages
+            else:
+                passages_ordered = [passages[idx] for idx in permutation]
+
+            if seps is not None:
+                passages_ordered = self._insert_separators(passages_ordered, seps)
+
+            self._log_example(i, passages, passages_ordered)
+
+            if join_sents or self.aggregate:
+                passages_ordered = " ".join(passages_ordered)
+
+            example_sorted = {
+                "sents" : passages_ordered,
+                "text" : example["text"]
+            }
+            writer.write(example_sorted, idx=i)
+
+            if stream:
+                writer.flush()
+
+        writer.close(num_examples)
+
+    def order_dataset_indices(self, in_filename, out_filename, shuffle=False, stream=False):
+        writer = self._open_writer(out_filename, format="text")
+        completed = getattr(writer, "completed", set())
+        num_examples = 0
+
+        for i, (example, permutation, _) in enumerate(self._read_ordered(in_filename, shuffle, stream, completed)):
+            num_examples += 1
+
+            if i in completed:
+                continue
+
+            if permutation is None:
+                # skip trivial examples (an empty output keeps the example completed)
+                writer.write("", idx=i)
+                continue
+
+            indices = np.argsort(permutation)
+
+            self._log_example(i, example["sents"], indices)
+
+            writer.write(" ".join([str(x) for x in indices]) + "\n", idx=i)
+
+        writer.close(num_examples)
 
 
 if __name__ == '__main__':
@@ -97,6 +224,12 @@ if __name__ == '__main__':
                     help='Output only permutation indices')
     parser.add_argument('--join_sents', action="store_true",
                     help='Join sentences to a single string on the output.')
+    parser.add_argument('--aggregate', action="store_true",
+                    help='Use the multi-task ordering + aggregation model (trained with --module ord_agg) and insert \
+                        the predicted separators between the ordered sentences. The ordering cache and the hierarchical \
+                        mode are not used.')
+    parser.add_argument("--separator", type=str, default="<sep>",
+        help="Separator token (with --aggregate).")
     parser.add_argument('--shuffle', action="store_true",
                     help='Shuffle the sentences before ordering.')
     parser.add_argument("--seed", type=int, default=42,
@@ -107,6 +240,46 @@ if __name__ == '__main__':
     #     help="Random seed")
     parser.add_argument("--max_length", type=int, default=1024,
         help="Maximum number of tokens per example")
+    parser.add_argument("--quantize", type=str, default=None, choices=["int8"],
+        help="Apply dynamic quantization to the Linear layers of the model for CPU inference. The quantized model \
+            is saved next to the checkpoint and loaded in the next runs.")
+    parser.add_argument("--batch_size", type=int, default=16,
+        help="Number of examples ordered in a single batch.")
+    parser.add_argument("--decoding", type=str, default="sentence", choices=["sentence", "token", "pairwise"],
+        help="Call the ordering model only at sentence boundaries (sentence), for each decoded token (token), \
+            or once to score all pairs of sentences and search for the best permutation (pairwise).")
+    parser.add_argument("--exact_search_max_sents", type=int, default=10,
+        help="Maximum number of sentences for the exact permutation search in the pairwise mode \
+            (a greedy search with 2-opt is used for longer inputs).")
+    parser.add_argument("--exhaustive_max_sents", type=int, default=0,
+        help="Order inputs with up to this number of sentences by scoring all their permutations \
+            in a single batched forward pass (0 = disabled).")
+    parser.add_argument('--hierarchical', action="store_true",
+                    help='Order the inputs longer than max_length hierarchically: order the blocks of sentences \
+                        and then the blocks instead of truncating the input.')
+    parser.add_argument("--block_size", type=int, default=8,
+        help="Maximum number of sentences in a block in the hierarchical mode.")
+    parser.add_argument("--cache_size", type=int, default=0,
+        help="Number of orders kept in the in-memory cache keyed on the set of input sentences (0 = disabled). \
+            The inputs are ordered in a canonical order of sentences if the cache is used.")
+    parser.add_argument("--cache_dir", type=str, default=None,
+        help="Directory for the on-disk cache of orders, persistent across runs (default = no on-disk cache).")
+    parser.add_argument('--stream', action="store_true",
+                    help='Read the input incrementally (JSONL input is used if available) and write the output \
+                        as JSONL after each chunk of examples.')
+    parser.add_argument("--stream_chunk_size", type=int, default=256,
+        help="Number of examples read and ordered at once in the streaming mode.")
+    parser.add_argument("--log_every", type=int, default=1,
+        help="Log every n-th example (0 = do not log the examples).")
+    parser.add_argument("--prefetch_batches", type=int, default=0,
+        help="Tokenize up to this number of next batches and post-process the previous batches in background threads \
+            while the model runs (0 = sequential processing). The time the model waits for them is logged.")
+    parser.add_argument('--resume', action="store_true",
+                    help='Write the outputs to a journal <output file>.partial synced to the disk periodically and skip \
+                        the examples already in the journal if the previous run was interrupted. The output file is \
+                        written at the end.')
+    parser.add_argument("--sync_every", type=int, default=100,
+        help="Number of outputs after which the journal is synced to the disk (with --resume).")
     args = parser.parse_args()
 
 
@@ -118,16 +291,27 @@ if __name__ == '__main__':
     os.makedirs(out_dir, exist_ok=True)
 
     for split in args.splits:
+        if args.stream:
+            in_filename = input_filename(args.in_dir, split)
+            out_ext = "jsonl"
+        else:
+            in_filename = os.path.join(args.in_dir, f"{split}.json")
+            out_ext = "json"
+
         if args.indices_only:
             dom.order_dataset_indices(
-                in_filename=os.path.join(args.in_dir, f"{split}.json"),
+                in_filename=in_filename,
                 out_filename=os.path.join(out_dir, f"{split}.out"),
-                shuffle=args.shuffle
+                shuffle=args.shuffle,
+                stream=args.stream
             )
         else:
             dom.order_dataset(
-                in_filename=os.path.join(args.in_dir, f"{split}.json"),
-                out_filename=os.path.join(out_dir, f"{split}.json"),
+                in_filename=in_filename,
+                out_filename=os.path.join(out_dir, f"{split}.{out_ext}"),
                 join_sents=args.join_sents,
-                shuffle=args.shuffle
-            )
\ No newline at end of file
+                shuffle=args.shuffle,
+                stream=args.stream
+            )
+
+    dom.model.pipeline.log_stats()
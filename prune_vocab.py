@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import numpy as np
+import os
+import re
+import torch
+import torch.nn as nn
+
+from tokenizers import Tokenizer
+from transformers import PreTrainedTokenizerFast
+from model import (
+    OrdTrainingModule,
+    OrdAggTrainingModule,
+    PCTrainingModule,
+)
+from utils.streaming import chunks, input_filename, read_examples
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def read_texts(in_dirs, splits, template_filenames):
+    """
+    Iterate over the texts the models are applied to: the input sentences and the target texts of the datasets
+    and the fixed parts of the templates (without the placeholders).
+    """
+    for in_dir in in_dirs:
+        for split in splits:
+            filename = input_filename(in_dir, split)
+
+            if not os.path.exists(filename):
+                logger.warning(f"{filename} not found, skipping")
+                continue
+
+            for example in read_examples(filename):
+                sents = example["sents"]
+                yield from [sents] if isinstance(sents, str) else sents
+                yield example["text"]
+
+    def template_strings(templates):
+        if isinstance(templates, str):
+            yield templates
+        else:
+            for value in templates.values() if isinstance(templates, dict) else templates:
+                yield from template_strings(value)
+
+    for template_filename in template_filenames:
+        with open(template_filename) as f:
+            for template in template_strings(json.load(f)):
+                yield from [s.strip() for s in re.split(r"<[a-z_]+>", template) if s.strip()]
+
+
+def used_token_ids(tokenizer, texts, batch_size=1024):
+    """
+    Ids of all the tokens in the texts (tokenized both at the beginning and in the middle of a text).
+    """
+    used = set()
+
+    for batch in chunks(texts, batch_size):
+        for ids in tokenizer(batch + [" " + text for text in batch], add_special_tokens=False)["input_ids"]:
+            used.update(ids)
+
+    return used
+
+
+def sample_texts(texts, sample, max_samples, seed=42):
+    """
+    Pass the texts through, keeping a uniform random sample of at most `max_samples` texts in the list `sample`
+    (reservoir sampling, the texts are read only once).
+    """
+    rng = np.random.RandomState(seed)
+
+    for i, text in enumerate(texts):
+        if len(sample) < max_samples:
+            sample.append(text)
+        else:
+            j = rng.randint(i + 1)
+
+            if j < max_samples:
+                sample[j] = text
+
+        yield text
+
+
+def _merge_parts(merge):
+    return merge.split(" ") if isinstance(merge, str) else merge
+
+
+def prune_tokenizer(tokenizer, used_ids):
+    """
+    Build a byte-level BPE tokenizer with the vocabulary restricted to `used_ids`, the special tokens,
+    the byte alphabet and the tokens from which the kept tokens are merged. The texts made of the used tokens
+    are tokenized the same way as with the original tokenizer, other texts fall back to shorter tokens.
+    Returns the tokenizer and the ids of the kept tokens in the original vocabulary (in the original order,
+    i.e. the new id of a token is its position in the list).
+    """
+    state = json.loads(tokenizer.backend_tokenizer.to_str())
+    bpe = state["model"]
+
+    if bpe["type"] != "BPE":
+        raise ValueError(f"Only BPE tokenizers can be pruned, got {bpe['type']}")
+
+    id_to_token = {idx: token for token, idx in bpe["vocab"].items()}
+    merged_from = {}
+
+    for merge in bpe["merges"]:
+        left, right = _merge_parts(merge)
+        merged_from.setdefault(left + right, []).append((left, right))
+
+    kept_tokens = {token for token in bpe["vocab"] if len(token) == 1}
+    stack = [id_to_token[idx] for idx in used_ids if idx in id_to_token]
+
+    # all the tokens on the merge paths of the used tokens are needed for the same tokenization
+    while stack:
+        token = stack.pop()
+
+        if token in kept_tokens:
+            continue
+
+        kept_tokens.add(token)
+
+        for parts in merged_from.get(token, []):
+            stack += [part for part in parts if part not in kept_tokens]
+
+    kept_ids = {bpe["vocab"][token] for token in kept_tokens}
+    kept_ids |= {token["id"] for token in state["added_tokens"]}
+    kept_ids |= set(tokenizer.all_special_ids)
+    kept_ids = sorted(kept_ids)
+    new_ids = {idx: new_idx for new_idx, idx in enumerate(kept_ids)}
+
+    bpe["vocab"] = {token: new_ids[idx] for token, idx in bpe["vocab"].items() if idx in new_ids}
+    bpe["merges"] = [
+        merge for merge in bpe["merges"]
+        if all(part in kept_tokens for part in _merge_parts(merge)) and "".join(_merge_parts(merge)) in kept_tokens
+    ]
+    state["added_tokens"] = [dict(token, id=new_ids[token["id"]]) for token in state["added_tokens"]]
+    _remap_post_processor(state["post_processor"], new_ids)
+
+    pruned = PreTrainedTokenizerFast(
+        tokenizer_object=Tokenizer.from_str(json.dumps(state)),
+        model_max_length=tokenizer.model_max_length,
+        model_input_names=tokenizer.model_input_names,
+        padding_side=tokenizer.padding_side,
+        **tokenizer.special_tokens_map
+    )
+    return pruned, kept_ids
+
+
+def _remap_post_processor(processor, new_ids):
+    if processor is None:
+        return
+
+    if processor["type"] in ["RobertaProcessing", "BertProcessing"]:
+        for key in ["sep", "cls"]:
+            processor[key][1] = new_ids[processor[key][1]]
+    elif processor["type"] == "TemplateProcessing":
+        for special_token in processor["special_tokens"].values():
+            special_token["ids"] = [new_ids[idx] for idx in special_token["ids"]]
+    elif processor["type"] == "Sequence":
+        for p in processor["processors"]:
+            _remap_post_processor(p, new_ids)
+
+
+def prune_embeddings(model, kept_ids):
+    """
+    Keep only the rows `kept_ids` of the input embeddings and of the output projection (shared or not) of a BART model.
+    Modifies the model in place.
+    """
+    idxs = torch.tensor(kept_ids)
+    new_ids = {idx: new_idx for new_idx, idx in enumerate(kept_ids)}
+    output_embeddings = model.get_output_embeddings() if hasattr(model, "get_output_embeddings") else None
+    weights = {model.get_input_embeddings().weight}
+
+    if output_embeddings is not None:
+        weights.add(output_embeddings.weight)
+
+    for weight in weights:
+        pruned_weight = nn.Parameter(weight.data[idxs].clone(), requires_grad=weight.requires_grad)
+
+        # the tied modules share the same parameter
+        for module in model.modules():
+            if isinstance(module, nn.Embedding) and module.weight is weight:
+                module.weight = pruned_weight
+                module.num_embeddings = len(kept_ids)
+
+                if module.padding_idx is not None:
+                    module.padding_idx = new_ids[module.padding_idx]
+            elif isinstance(module, nn.Linear) and module.weight is weight:
+                module.weight = pruned_weight
+                module.out_features = len(kept_ids)
+
+    if hasattr(model, "final_logits_bias"):
+        model.register_buffer("final_logits_bias", model.final_logits_bias[:, idxs].clone())
+
+    config = model.config
+    config.vocab_size = len(kept_ids)
+
+    for key in ["pad_token_id", "bos_token_id", "eos_token_id", "decoder_start_token_id",
+            "forced_bos_token_id", "forced_eos_token_id"]:
+        if getattr(config, key, None) is not None:
+            setattr(config, key, new_ids[getattr(config, key)])
+
+    return model
+
+
+def check_tokenization(tokenizer, pruned_tokenizer, kept_ids, texts):
+    """
+    Number of texts tokenized the same way with the pruned tokenizer as with the original one.
+    """
+    new_ids = {idx: new_idx for new_idx, idx in enumerate(kept_ids)}
+    identical = 0
+
+    for text in texts:
+        ids = tokenizer(text)["input_ids"]
+        identical += [new_ids.get(idx) for idx in ids] == pruned_tokenizer(text)["input_ids"]
+
+    return identical
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exp_dir", default="experiments", type=str,
+        help="Base directory of the experiment.")
+    parser.add_argument("--experiment", type=str, required=True,
+        help="Experiment name.")
+    parser.add_argument("--checkpoint", type=str, default="model.ckpt",
+        help="Override the default checkpoint name 'model.ckpt'.")
+    parser.add_argument("--module", type=str, required=True, choices=["pc", "ord", "ord_agg"],
+        help="Pipeline module: pc (applies to all variants) / ord / ord_agg")
+    parser.add_argument("--in_dirs", type=str, nargs="+", required=True,
+        help="Directories with the datasets from which the used tokens are collected.")
+    parser.add_argument("--splits", type=str, nargs="+", default=["train", "dev", "test"],
+        help="Dataset splits from which the used tokens are collected.")
+    parser.add_argument("--templates", type=str, nargs="*", default=[],
+        help="JSON files with templates from which the used tokens are collected (e.g. templates/templates-webnlg.json).")
+    parser.add_argument("--out_checkpoint", type=str, default="model.pruned.ckpt",
+        help="Name of the pruned checkpoint in the experiment directory (loaded with --checkpoint).")
+    parser.add_argument("--out_model_dir", type=str, default=None,
+        help="Directory for the pruned pretrained model and tokenizer referenced by the pruned checkpoint \
+            (default = <exp_dir>/<experiment>/pruned).")
+    parser.add_argument("--max_check_examples", type=int, default=1000,
+        help="Maximum number of texts for checking the tokenization of the pruned tokenizer.")
+    args = parser.parse_args()
+
+    logger.info(args)
+
+    model_path = os.path.join(args.exp_dir, args.experiment, args.checkpoint)
+    # the pruned checkpoint refers to the model directory independently of the working directory
+    out_model_dir = os.path.abspath(args.out_model_dir or os.path.join(args.exp_dir, args.experiment, "pruned"))
+
+    training_module_cls = {
+        "pc" : PCTrainingModule,
+        "ord" : OrdTrainingModule,
+        "ord_agg" : OrdAggTrainingModule,
+    }[args.module]
+
+    model = training_module_cls.load_from_checkpoint(model_path, map_location="cpu")
+    model.freeze()
+    tokenizer = model.tokenizer
+
+    # the texts for checking the tokenization are sampled while collecting the used tokens
+    check_texts = []
+    texts = sample_texts(read_texts(args.in_dirs, args.splits, args.templates), check_texts, args.max_check_examples)
+    used_ids = used_token_ids(tokenizer, texts)
+    pruned_tokenizer, kept_ids = prune_tokenizer(tokenizer, used_ids)
+
+    logger.info(f"Used tokens: {len(used_ids)}, kept tokens: {len(kept_ids)} / {len(tokenizer)}")
+
+    # the hard-coded ids of the special tokens (e.g. the decoder start tokens of the ordering model) do not change
+    for token_id in [tokenizer.bos_token_id, tokenizer.pad_token_id, tokenizer.eos_token_id]:
+        assert kept_ids[token_id] == token_id
+
+    identical = check_tokenization(tokenizer, pruned_tokenizer, kept_ids, check_texts)
+    logger.info(f"Texts tokenized identically with the pruned tokenizer: {identical}/{len(check_texts)}")
+
+    num_params = sum(p.numel() for p in model.parameters())
+    prune_embeddings(model.model, kept_ids)
+    logger.info(f"Parameters: {num_params} -> {sum(p.numel() for p in model.parameters())}")
+
+    model.model.save_pretrained(out_model_dir)
+    pruned_tokenizer.save_pretrained(out_model_dir)
+    logger.info(f"Saved pruned model and tokenizer to {out_model_dir}")
+
+    # the pruned checkpoint loads the pruned model and tokenizer instead of the original pretrained model
+    checkpoint = torch.load(model_path, map_location="cpu")
+    checkpoint["state_dict"] = model.state_dict()
+    checkpoint["hyper_parameters"]["args"].model_name = out_model_dir
+
+    # the optimizer states do not match the pruned parameters
+    for key in ["optimizer_states", "lr_schedulers"]:
+        checkpoint.pop(key, None)
+
+    out_checkpoint = os.path.join(args.exp_dir, args.experiment, args.out_checkpoint)
+    torch.save(checkpoint, out_checkpoint)
+    logger.info(f"Saved pruned checkpoint to {out_checkpoint}")
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import logging
+import numpy as np
+import os
+import sacrebleu
+import time
+import torch
+
+from inference import (
+    OrdInferenceModule,
+    AggInferenceModule,
+    PCInferenceModule,
+)
+from dataloader import pc_input_text
+from utils.streaming import chunks, read_examples
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(message)s', level=logging.INFO, datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+
+def evaluate_ord(dm, examples, args):
+    """
+    Accuracy of the orders of the shuffled sentences (the sentences in the dataset are in the correct order).
+    """
+    examples = [example for example in examples if len(example["sents"]) > 1]
+    rng = np.random.RandomState(args.seed)
+    shuffled = [rng.permutation(len(example["sents"])) for example in examples]
+
+    permutations = dm.order_batch(
+        [[example["sents"][k] for k in perm] for example, perm in zip(examples, shuffled)],
+        batch_size=args.batch_size
+    )
+    outputs = [perm[permutation].tolist() for perm, permutation in zip(shuffled, permutations)]
+    correct = sum(output == list(range(len(output))) for output in outputs)
+
+    return {"accuracy": correct / len(outputs)}, outputs
+
+
+def evaluate_agg(dm, examples, args):
+    """
+    Accuracy of the predicted separators.
+    """
+    examples = [example for example in examples if len(example["sents"]) > 1]
+    outputs = []
+
+    for batch in chunks(examples, args.batch_size):
+        outputs += dm.predict_batch([example["sents"] for example in batch])
+
+    correct = sum(output == example["sep"] for output, example in zip(outputs, examples))
+    correct_pos = sum(np.sum(np.array(output) == np.array(example["sep"])) for output, example in zip(outputs, examples))
+    total_pos = sum(len(example["sep"]) for example in examples)
+
+    return {"accuracy": correct / len(outputs), "accuracy per position": correct_pos / total_pos}, outputs
+
+
+def evaluate_pc(dm, examples, args):
+    """
+    BLEU of the generated texts.
+    """
+    outputs = []
+
+    for batch in chunks(examples, args.batch_size):
+        inputs = dm.tokenizer(
+            [pc_input_text(example["sents"], example.get("sep")) for example in batch],
+            padding=True,
+            truncation=True,
+            max_length=args.max_length,
+            return_tensors="pt"
+        ).to(dm.model.device)
+        out = dm.model.model.generate(inputs["input_ids"],
+            attention_mask=inputs["attention_mask"],
+            max_length=args.max_length,
+            num_beams=args.beam_size
+        )
+        outputs += dm.tokenizer.batch_decode(out,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=True
+        )
+
+    bleu = sacrebleu.corpus_bleu(outputs, [[example["text"] for example in examples]])
+
+    return {"BLEU": bleu.score}, outputs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--exp_dir", default="experiments", type=str,
+        help="Base directory of the experiment.")
+    parser.add_argument("--experiment", type=str, required=True,
+        help="Experiment name.")
+    parser.add_argument("--checkpoint", type=str, default="model.ckpt",
+        help="Override the default checkpoint name 'model.ckpt'.")
+    parser.add_argument("--module", type=str, required=True, choices=["pc", "ord", "agg"],
+        help="Pipeline module: pc (applies to all variants) / ord / agg")
+    parser.add_argument("--quantize", type=str, default="int8", choices=["int8"],
+        help="Quantization type.")
+    parser.add_argument("--in_dir", type=str, default=None,
+        help="Directory with the dataset for comparing the quantized model with the original model \
+            (default = only quantize and save the model).")
+    parser.add_argument("--split", type=str, default="dev",
+        help="Dataset split used for the comparison.")
+    parser.add_argument("--max_examples", type=int, default=None,
+        help="Maximum number of examples used for the comparison (default = all).")
+    parser.add_argument("--seed", type=int, default=42,
+        help="Random seed.")
+    parser.add_argument("--max_threads", default=4, type=int,
+        help="Maximum number of threads.")
+    parser.add_argument("--batch_size", type=int, default=16,
+        help="Number of examples processed in a single batch.")
+    parser.add_argument("--beam_size", default=1, type=int,
+        help="Beam size (pc).")
+    parser.add_argument("--max_length", type=int, default=1024,
+        help="Maximum number of tokens per example")
+    args = parser.parse_args()
+
+    logger.info(args)
+
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    torch.set_num_threads(args.max_threads)
+
+    model_path = os.path.join(args.exp_dir, args.experiment, args.checkpoint)
+
+    inference_module_cls, evaluate = {
+        "pc" : (PCInferenceModule, evaluate_pc),
+        "ord" : (OrdInferenceModule, evaluate_ord),
+        "agg" : (AggInferenceModule, evaluate_agg),
+    }[args.module]
+
+    # both models run on CPU
+    args.gpus = 0
+    dm_quantized = inference_module_cls(args, model_path=model_path)
+
+    if args.in_dir is not None:
+        args_fp32 = copy.copy(args)
+        args_fp32.quantize = None
+        dm_fp32 = inference_module_cls(args_fp32, model_path=model_path)
+
+        examples = list(read_examples(os.path.join(args.in_dir, f"{args.split}.json")))[:args.max_examples]
+        results = {}
+
+        for name, dm in [("fp32", dm_fp32), (args.quantize, dm_quantized)]:
+            start = time.time()
+            metrics, outputs = evaluate(dm, examples, args)
+            metrics["time (s)"] = time.time() - start
+            results[name] = (metrics, outputs)
+
+            logger.info(f"{name}: " + ", ".join(f"{key}: {value:.4f}" for key, value in metrics.items()))
+
+        agreement = np.mean([a == b for a, b in zip(results["fp32"][1], results[args.quantize][1])])
+        logger.info(f"Outputs identical with fp32: {agreement:.4f}")
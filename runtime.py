@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+
+"""
+Lightweight runtime for the models exported with export.py (TorchScript graphs running on CPU).
+Does not depend on PyTorch Lightning or on the training code.
+"""
+
+import json
+import logging
+import os
+import torch
+import torch.nn as nn
+
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+from transformers import AutoConfig, AutoTokenizer
+from transformers.modeling_outputs import ModelOutput
+from utils.generation import default_logits_processor
+from utils.ordering_utils import OrderingMixin
+
+logger = logging.getLogger(__name__)
+
+
+def flatten_past(past_key_values):
+    """
+    Flatten the decoder cache (a tuple of (self-attention key, value, cross-attention key, value) for each layer)
+    to a tuple of tensors (the exported graphs accept only tensors).
+    """
+    return tuple(state for layer_past in past_key_values for state in layer_past)
+
+
+def unflatten_past(states):
+    return tuple(tuple(states[i:i+4]) for i in range(0, len(states), 4))
+
+
+def load_exported(export_dir, max_length=1024):
+    """
+    Load the runtime for the model exported to `export_dir`.
+    """
+    with open(os.path.join(export_dir, "export.json")) as f:
+        module = json.load(f)["module"]
+
+    runtime_cls = {
+        "pc" : ExportedPCModel,
+        "agg" : ExportedAggModel,
+        "ord" : ExportedOrdModel,
+    }[module]
+
+    return runtime_cls(export_dir, max_length=max_length)
+
+
+def _load_graph(export_dir, name):
+    return torch.jit.load(os.path.join(export_dir, f"{name}.pt"), map_location="cpu")
+
+
+class ExportedPCModel:
+    """
+    Paragraph compression model: the encoder and the decoder with cached states (greedy decoding).
+    """
+    def __init__(self, export_dir, max_length=1024):
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir, use_fast=True)
+        self.config = AutoConfig.from_pretrained(export_dir)
+
+        self.encoder = _load_graph(export_dir, "encoder")
+        self.decoder_init = _load_graph(export_dir, "decoder_init")
+        self.decoder_with_past = _load_graph(export_dir, "decoder_with_past")
+
+    @torch.no_grad()
+    def generate(self, input_ids, attention_mask, max_length=None):
+        """
+        Greedy decoding, the same output as `generate` with `num_beams=1`. Only the last token is fed
+        to the decoder in each step.
+        """
+        max_length = max_length or self.max_length
+        logits_processor = default_logits_processor(self.config, max_length)
+        pad_token_id = self.config.pad_token_id
+        eos_token_id = self.config.eos_token_id
+
+        encoder_hidden_states = self.encoder(input_ids, attention_mask)
+        output_ids = input_ids.new_full((input_ids.size(0), 1), self.config.decoder_start_token_id)
+        unfinished = torch.ones_like(output_ids[:, 0], dtype=torch.bool)
+        outputs = self.decoder_init(output_ids, encoder_hidden_states, attention_mask)
+
+        while True:
+            scores = logits_processor(output_ids, outputs[0][:, -1, :])
+            next_tokens = torch.where(unfinished, scores.argmax(-1), torch.full_like(output_ids[:, 0], pad_token_id))
+            output_ids = torch.cat([output_ids, next_tokens.unsqueeze(-1)], dim=-1)
+            unfinished = unfinished & (next_tokens != eos_token_id)
+
+            if not unfinished.any() or output_ids.size(1) >= max_length:
+                break
+
+            outputs = self.decoder_with_past(next_tokens.unsqueeze(-1), encoder_hidden_states, attention_mask, *outputs[1:])
+
+        return output_ids
+
+    def predict_batch(self, texts):
+        inputs = self.tokenizer(texts,
+            max_length=self.max_length,
+            truncation=True,
+            padding=True,
+            return_tensors="pt"
+        )
+        out = self.generate(inputs["input_ids"], inputs["attention_mask"])
+
+        return self.tokenizer.batch_decode(out,
+            skip_special_tokens=True,
+            clean_up_tokenization_spaces=True
+        )
+
+    def predict(self, s, beam_size=1):
+        return self.predict_batch([s])
+
+
+class ExportedAggModel:
+    """
+    Aggregation model (token classifier).
+    """
+    def __init__(self, export_dir, max_length=1024):
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir, use_fast=True)
+        self.classifier = _load_graph(export_dir, "classifier")
+
+    @torch.no_grad()
+    def predict_batch(self, sents_batch):
+        """
+        Predict the separators between the sentences for a batch of examples (see `AggInferenceModule`).
+        """
+        text = [f" {self.tokenizer.sep_token} ".join(sents) for sents in sents_batch]
+
+        inputs = self.tokenizer(text,
+            max_length=self.max_length,
+            truncation=True,
+            padding=True,
+            return_tensors='pt'
+        )
+        preds = torch.argmax(self.classifier(inputs["input_ids"], inputs["attention_mask"]), axis=2)
+
+        sep_mask = inputs["input_ids"] == self.tokenizer.sep_token_id
+        seps = torch.split(preds[sep_mask], sep_mask.sum(-1).tolist())
+
+        return [s[:-1].tolist() for s in seps]
+
+    def predict(self, sents, beam_size=1):
+        return self.predict_batch([sents])[0]
+
+
+@dataclass
+class OrderingOutput(ModelOutput):
+    logits: torch.FloatTensor = None
+    sequence_positions: Optional[torch.LongTensor] = None
+    pointer_keys: Optional[torch.FloatTensor] = None
+    past_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None
+
+
+class ExportedOrdModel(nn.Module, OrderingMixin):
+    """
+    Ordering model: the encoder, the decoder with cached states producing the pointer queries and
+    the projection of the pointer keys. All the decoding modes of `OrderingMixin` are supported.
+    """
+    def __init__(self, export_dir, max_length=1024):
+        super().__init__()
+        self.max_length = max_length
+        self.tokenizer = AutoTokenizer.from_pretrained(export_dir, use_fast=True)
+        self.eos_token_id = self.tokenizer.eos_token_id
+        self.pad_token_id = self.tokenizer.pad_token_id
+
+        self.encoder = _load_graph(export_dir, "encoder")
+        self.decoder_init = _load_graph(export_dir, "decoder_init")
+        self.decoder_with_past = _load_graph(export_dir, "decoder_with_past")
+        self.pointer_keys = _load_graph(export_dir, "pointer_keys")
+
+    def is_sequence_ordering_model(self):
+        return True
+
+    def get_encoder(self):
+        return lambda input_ids, attention_mask: (self.encoder(input_ids, attention_mask),)
+
+    def prepare_inputs_for_generation(
+        self, decoder_input_ids, past, input_ids, attention_mask, use_cache, encoder_outputs, **kwargs
+    ):
+        return {
+            "input_ids": input_ids,
+            "encoder_outputs": encoder_outputs,
+            "past_key_values": past,
+            "decoder_input_ids": decoder_input_ids,
+            "attention_mask": attention_mask,
+            "use_cache": use_cache,
+            "pointer_keys": kwargs.get("pointer_keys"),
+        }
+
+    @staticmethod
+    def _reorder_cache(past, beam_idx):
+        return tuple(
+            tuple(past_state.index_select(0, beam_idx) for past_state in layer_past[:2]) + layer_past[2:]
+            for layer_past in past
+        )
+
+    def forward(self,
+            input_ids,
+            attention_mask=None,
+            encoder_outputs=None,
+            decoder_input_ids=None,
+            past_key_values=None,
+            use_cache=None,
+            pointer_keys=None,
+            **kwargs
+        ):
+        """
+        Pointer logits between the sequence representations (see `OrdTrainingModule.forward`).
+        """
+        if attention_mask is None:
+            attention_mask = input_ids.new_ones(input_ids.shape)
+
+        if encoder_outputs is None:
+            encoder_outputs = self.get_encoder()(input_ids, attention_mask)
+
+        encoder_hidden_states = encoder_outputs[0]
+
+        if past_key_values is None:
+            outputs = self.decoder_init(decoder_input_ids, encoder_hidden_states, attention_mask)
+        else:
+            outputs = self.decoder_with_past(
+                decoder_input_ids, encoder_hidden_states, attention_mask, *flatten_past(past_key_values)
+            )
+        queries = outputs[0]
+
+        sequence_positions, sequence_mask = self._gather_positions(input_ids == self.eos_token_id)
+
+        if pointer_keys is None:
+            pointer_keys = self.pointer_keys(self._gather_states(encoder_hidden_states, sequence_positions))
+
+        if use_cache:
+            queries = queries[:, -1:]
+            query_mask = decoder_input_ids[:, -1:] == self.eos_token_id
+        else:
+            query_mask = decoder_input_ids == self.eos_token_id
+
+        logits = torch.bmm(queries, pointer_keys.transpose(1, 2))
+        logits = logits.masked_fill(~(query_mask.unsqueeze(-1) & sequence_mask.unsqueeze(1)), float("-inf"))
+
+        return OrderingOutput(
+            logits=logits,
+            sequence_positions=sequence_positions,
+            pointer_keys=pointer_keys,
+            past_key_values=unflatten_past(outputs[1:]),
+        )
+
+    def _join_sequences(self, sequences):
+        return f" {self.tokenizer.eos_token}{self.tokenizer.bos_token} ".join(sequences) \
+                + f" {self.tokenizer.eos_token}{self.tokenizer.bos_token}"
+
+    def _postprocess_order(self, output, sequences):
+        output = list(output)
+        output.remove(max(output))
+        for i in range(len(sequences)):
+            if i not in output:
+                output.append(i)
+        return output
+
+    def order_batch(self, sequences_batch, batch_size=16, decoder_start_token_ids=[0, 2], num_beams=1):
+        """
+        Order a list of examples (each example is a list of sentences) in padded batches (sentence-level decoding).
+        Returns the permutation of sentence indices for each example.
+        """
+        sorted_idxs = sorted(range(len(sequences_batch)), key=lambda i: -len(self._join_sequences(sequences_batch[i])))
+        outputs = [None] * len(sequences_batch)
+
+        for b in range(0, len(sorted_idxs), batch_size):
+            batch_idxs = sorted_idxs[b:b+batch_size]
+            inputs = self.tokenizer(
+                [self._join_sequences(sequences_batch[i]) for i in batch_idxs],
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="pt",
+            )
+            output = self.order(
+                input_ids=inputs["input_ids"],
+                attention_mask=inputs["attention_mask"],
+                decoder_start_token_ids=decoder_start_token_ids,
+                num_beams=num_beams,
+                sentence_level=True,
+            )
+            for i, out in zip(batch_idxs, output):
+                outputs[i] = self._postprocess_order(out, sequences_batch[i])
+
+        return outputs
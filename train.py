@@ -3,12 +3,14 @@
 from model import (
     D2TTrainingModule,
     OrdTrainingModule,
+    OrdAggTrainingModule,
     AggTrainingModule,
     PCTrainingModule
 )
 from dataloader import (
     D2TDataModule,
     OrdDataModule,
+    OrdAggDataModule,
     AggDataModule,
     PCDataModule,
     PCAggDataModule, 
@@ -35,6 +37,7 @@ def parse_args(args=None):
         help="Name of the pipeline module to be trained:\
             ord = ordering \
             agg = aggregation \
+            ord_agg = ordering + aggregation (multi-task model with a shared encoder) \
             pc = paragraph compression \
             pc_agg = paragraph compression + aggregation \
             pc_ord_agg = paragraph compression + ordering + aggregation."
@@ -59,6 +62,9 @@ def parse_args(args=None):
         help="Random seed.")
     parser.add_argument("--max_threads", default=8, type=int,
         help="Maximum number of CPU threads.")
+    parser.add_argument("--distill_from", type=str, default=None,
+        help="Checkpoint of a trained model of the same module used as a teacher: the model is trained on the outputs \
+            of the teacher (see --student_encoder_layers, --student_decoder_layers and --distill_alpha).")
     parser.add_argument("--resume_training", action="store_true",
         help="Resume training from the loaded checkpoint (useful if training was interrupted).")
     
@@ -72,6 +78,7 @@ if __name__ == '__main__':
 
     training_module = {
         "ord" : OrdTrainingModule,
+        "ord_agg" : OrdAggTrainingModule,
         "agg" : AggTrainingModule,
         "pc" : PCTrainingModule,    # training module is the same for PC* modules
         "pc_agg" : PCTrainingModule,
@@ -80,6 +87,7 @@ if __name__ == '__main__':
 
     data_module = {
         "ord" : OrdDataModule,
+        "ord_agg" : OrdAggDataModule,
         "agg" : AggDataModule,
         "pc" : PCDataModule,
         "pc_agg" : PCAggDataModule,
@@ -105,6 +113,16 @@ if __name__ == '__main__':
 
         if args.resume_training:
             logger.error("Model path not specified, training not resumed.")
+
+    if args.distill_from:
+        if args.distill_pseudo_targets and training_module != PCTrainingModule:
+            raise ValueError("Teacher pseudo-targets are supported only for the pc modules")
+
+        logger.info(f"Distilling from {args.distill_from}")
+        # a student loaded from a checkpoint keeps its weights
+        model.set_teacher(training_module.load_from_checkpoint(args.distill_from),
+            init_student=not args.model_path
+        )
         
     ckpt_out_dir = os.path.join(args.out_dir,
         args.experiment
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+
+"""
+Caches for the outputs of the pipeline models.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def file_fingerprint(path, chunk_size=1 << 20):
+    """
+    Return a SHA-1 hash of the file content (used to tie the cached outputs to a specific checkpoint).
+    """
+    sha = hashlib.sha1()
+
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+
+    return sha.hexdigest()
+
+
+def cache_key(*items):
+    """
+    Return a string key for a list of JSON-serializable items.
+    """
+    return hashlib.sha1(json.dumps(items, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    Key-value cache with an in-memory LRU tier and an optional persistent tier (SQLite database).
+    Keys are strings, values are JSON-serializable objects.
+    """
+    def __init__(self, max_size=100000, path=None):
+        self.max_size = max_size
+        self.memory = OrderedDict()
+        self.db = None
+        self.hits = 0
+        self.misses = 0
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.db = sqlite3.connect(path)
+            self.db.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT)")
+            logger.info(f"Using cache {path}")
+
+    def _put_memory(self, key, value):
+        if self.max_size <= 0:
+            return
+
+        self.memory[key] = value
+        self.memory.move_to_end(key)
+
+        if len(self.memory) > self.max_size:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.hits += 1
+            return self.memory[key]
+
+        if self.db is not None:
+            row = self.db.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+
+            if row is not None:
+                value = json.loads(row[0])
+                self._put_memory(key, value)
+                self.hits += 1
+                return value
+
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._put_memory(key, value)
+
+        if self.db is not None:
+            self.db.execute(
+                "INSERT OR REPLACE INTO cache (key, value) VALUES (?, ?)",
+                (key, json.dumps(value, ensure_ascii=False))
+            )
+
+    def flush(self):
+        """
+        Write the pending values to the persistent tier.
+        """
+        if self.db is not None:
+            self.db.commit()
+
+    def close(self):
+        if self.db is not None:
+            self.db.commit()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+"""
+Greedy decoding utilities for the paragraph compression model.
+"""
+
+import logging
+import torch
+
+from transformers import (
+    ForcedBOSTokenLogitsProcessor,
+    ForcedEOSTokenLogitsProcessor,
+    LogitsProcessorList,
+    MinLengthLogitsProcessor,
+    NoRepeatNGramLogitsProcessor,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def default_logits_processor(config, max_length):
+    """
+    The logits processors applied by `generate` with the default settings of the model.
+    """
+    processors = LogitsProcessorList()
+
+    if config.no_repeat_ngram_size:
+        processors.append(NoRepeatNGramLogitsProcessor(config.no_repeat_ngram_size))
+    if config.min_length:
+        processors.append(MinLengthLogitsProcessor(config.min_length, config.eos_token_id))
+    if config.forced_bos_token_id is not None:
+        processors.append(ForcedBOSTokenLogitsProcessor(config.forced_bos_token_id))
+    if config.forced_eos_token_id is not None:
+        processors.append(ForcedEOSTokenLogitsProcessor(max_length, config.forced_eos_token_id))
+
+    return processors
+
+
+def copy_drafts(source_ids, output_ids, draft_length, ngram_size, pad_token_id):
+    """
+    Draft the continuation of each output by copying the tokens which follow the last occurrence
+    of the last `ngram_size` output tokens in the source. Returns the drafts padded with `pad_token_id`
+    (shape (batch_size, K), K <= draft_length).
+    """
+    drafts = []
+
+    for source, output in zip(source_ids.tolist(), output_ids.tolist()):
+        ngram = output[-ngram_size:]
+        draft = []
+
+        for i in range(len(source) - ngram_size - 1, -1, -1):
+            if source[i : i + ngram_size] == ngram:
+                draft = [t for t in source[i + ngram_size : i + ngram_size + draft_length] if t != pad_token_id]
+                break
+
+        drafts.append(draft)
+
+    length = max(len(draft) for draft in drafts)
+
+    return source_ids.new_tensor([draft + [pad_token_id] * (length - len(draft)) for draft in drafts]).view(len(drafts), length)
+
+
+def _crop_past(past_key_values, length):
+    # the cached cross-attention states do not depend on the decoder input
+    return tuple(
+        (layer_past[0][:, :, :length], layer_past[1][:, :, :length]) + tuple(layer_past[2:])
+        for layer_past in past_key_values
+    )
+
+
+@torch.no_grad()
+def copy_speculative_generate(model, input_ids, attention_mask, max_length, draft_length=10, ngram_size=2):
+    """
+    Greedy decoding of an encoder-decoder model (the same output as `generate` with `num_beams=1`)
+    with drafts copied from the input (see `copy_drafts`).
+
+    In each step, the decoder verifies the drafts of all the examples in a single forward pass. The outputs are
+    extended with the greedy tokens as long as they match the drafts in all the unfinished examples,
+    i.e. by one token for a rejected draft and by up to `draft_length + 1` tokens for an accepted one.
+    """
+    config = model.config
+    logits_processor = default_logits_processor(config, max_length)
+    pad_token_id = config.pad_token_id
+    eos_token_id = config.eos_token_id
+
+    encoder_outputs = model.get_encoder()(input_ids=input_ids, attention_mask=attention_mask, return_dict=True)
+    output_ids = input_ids.new_full((input_ids.size(0), 1), config.decoder_start_token_id)
+    unfinished = torch.ones_like(output_ids[:, 0], dtype=torch.bool)
+
+    past = None
+    past_length = 0
+    steps = 0
+
+    while True:
+        max_draft_length = min(draft_length, max_length - output_ids.size(1) - 1)
+
+        if max_draft_length > 0 and output_ids.size(1) >= ngram_size:
+            drafts = copy_drafts(input_ids, output_ids, max_draft_length, ngram_size, pad_token_id)
+        else:
+            drafts = output_ids.new_zeros((output_ids.size(0), 0))
+
+        # the outputs not in the cache yet + the drafts
+        new_ids = output_ids[:, past_length:]
+        outputs = model(
+            attention_mask=attention_mask,
+            encoder_outputs=encoder_outputs,
+            decoder_input_ids=torch.cat([new_ids, drafts], dim=-1),
+            past_key_values=past,
+            use_cache=True,
+        )
+        logits = outputs.logits[:, new_ids.size(1) - 1 :]
+        steps += 1
+
+        for k in range(drafts.size(1) + 1):
+            scores = logits_processor(output_ids, logits[:, k])
+            next_tokens = torch.where(unfinished, scores.argmax(-1), torch.full_like(unfinished, pad_token_id, dtype=torch.long))
+            output_ids = torch.cat([output_ids, next_tokens.unsqueeze(-1)], dim=-1)
+            unfinished = unfinished & (next_tokens != eos_token_id)
+
+            # the logits for the next positions are valid only if the draft was followed
+            # (no more positions are added once all the examples are finished, as in `generate`)
+            if k == drafts.size(1) or not unfinished.any() or (unfinished & (next_tokens != drafts[:, k])).any():
+                break
+
+        if not unfinished.any() or output_ids.size(1) >= max_length:
+            break
+
+        # the last output token is not in the cache yet
+        past_length = output_ids.size(1) - 1
+        past = _crop_past(outputs.past_key_values, past_length)
+
+    logger.debug(f"Decoded {output_ids.size(1) - 1} tokens in {steps} decoder steps")
+
+    return output_ids
@@ -18,6 +18,7 @@
 Code based on https://github.com/airKlizz/passage-ordering/blob/main/training/scripts/models/ordering_utils.py
 """
 
+import itertools
 import logging
 from typing import Iterable, List, Optional, Tuple, Union
 
@@ -25,6 +26,8 @@ import torch
 from torch import Tensor
 from torch.nn import functional as F
 
+from utils.permutation_search import best_path
+
 
 logger = logging.getLogger(__name__)
 
@@ -54,26 +57,67 @@ class OrderingMixin:
         scores,
         decoder_input_id,
         done,
-        ordered_sequences,
-        batch_size,
-        num_beams,
+        used,
     ):
         """
         Set scores to "-inf" when:
             1- the decoder_input_id is not eos (i.e. doesn't represent a sequence),
             2- the batch is done,
-            3- the sequence is already ordered.
+            3- the sequence is already ordered (`used`, shape (batch_size * num_beams, sequence_length)).
+        """
+        invalid = used | ((decoder_input_id != self.eos_token_id) | done).unsqueeze(-1)
+
+        return scores.masked_fill_(invalid, float("-inf"))
+
+    def _mark_used(self, used, next_sequence, selected):
+        """
+        Set `used` to True for the sequences `next_sequence` in the rows where `selected` is True.
+        """
+        update = torch.zeros_like(used).scatter_(1, next_sequence.clamp(min=0).unsqueeze(-1), selected.unsqueeze(-1))
+
+        return used | update
+
+    @staticmethod
+    def _gather_positions(mask):
+        """
+        Return the positions of the True values in each row of `mask` (shape (bsz, N), padded with 0)
+        and the mask of the valid positions.
+        """
+        counts = mask.sum(-1)
+        positions = torch.sort((~mask).long(), dim=-1, stable=True).indices[:, :counts.max()]
+        valid = torch.arange(positions.size(1), device=mask.device).unsqueeze(0) < counts.unsqueeze(-1)
+
+        return positions.masked_fill(~valid, 0), valid
+
+    @staticmethod
+    def _gather_states(hidden_states, positions):
+        return hidden_states.gather(1, positions.unsqueeze(-1).expand(-1, -1, hidden_states.size(-1)))
+
+    def _sequence_logits_to_positions(self, logits, sequence_positions, sequence_length):
+        """
+        Scatter the pointer logits of the sequences (shape (batch_size, N), see `sequence_positions` in the model
+        output) to the positions of their eos tokens in the input (shape (batch_size, sequence_length)).
+        """
+        return logits.new_full((logits.size(0), sequence_length), float("-inf")).scatter(1, sequence_positions, logits)
+
+    def _next_decoder_step(self, decoder_input_ids, decoder_step, done, sentence_level):
+        """
+        Return the next decoder position at which the model has to be called.
+
+        In the sentence-level mode, the positions inside the copied sentences are skipped: the pointer
+        is only evaluated at the sentence boundaries (eos tokens), the rest of the decoder input is a
+        deterministic copy of the selected sentence.
         """
-        # 1
-        scores[decoder_input_id != self.eos_token_id] = float("-inf")
-        # 2
-        scores[done] = float("-inf")
-        # 3
-        for idx in range(batch_size * num_beams):
-            for sequence in ordered_sequences[idx]:
-                scores[idx, sequence] = float("-inf")
+        if not sentence_level:
+            return decoder_step + 1
+
+        boundaries = (decoder_input_ids[:, decoder_step + 1 :] == self.eos_token_id) & ~done.unsqueeze(-1)
+        boundaries = boundaries.any(0).nonzero()
+
+        if boundaries.numel() == 0:
+            return decoder_input_ids.size(1)
 
-        return scores
+        return decoder_step + 1 + int(boundaries[0])
 
     @torch.no_grad()
     def order(
@@ -84,8 +128,23 @@ class OrderingMixin:
         decoder_start_token_ids: Optional[List[int]] = None,
         use_cache: Optional[bool] = None,
         specific_head: Optional[int] = None,
+        sentence_level: bool = False,
+        encoder_outputs: Optional[Tuple[Tensor]] = None,
         **model_specific_kwargs,
     ) -> torch.LongTensor:
+        """
+        Order the sequences (sentences terminated by eos) in `input_ids`.
+
+        With `sentence_level=True`, the model is called only at the sentence boundaries and the selected
+        sentence is appended to the decoder input in a single step, i.e. an input with N sentences
+        needs ~N forward passes instead of ~sequence_length. The output is the same as in the
+        token-level mode.
+
+        With `use_cache=True` (default), the decoder keeps its `past_key_values` between the steps
+        and only the newly appended positions are fed to the model.
+
+        `encoder_outputs` can be passed if the input was already encoded.
+        """
 
         # We cannot order if the model does not have a LM head
         if not self.is_sequence_ordering_model():
@@ -94,7 +153,8 @@ class OrderingMixin:
                 "Please use BartForSequenceOrdering"
             )
 
-        use_cache = False
+        if use_cache is None:
+            use_cache = True
 
         assert isinstance(use_cache, bool), "`use_cache` should be a boolean."
         assert isinstance(num_beams, int) and num_beams > 0, "`num_beams` should be a strictly positive integer."
@@ -123,32 +183,14 @@ class OrderingMixin:
         # done sentences
         done = torch.zeros((batch_size * num_beams), device=input_ids.device).bool()
 
-        # ordered_sequences
-        ordered_sequences = [[] for _ in range(batch_size)]
-
-        # remained sequences to order
-        remained_sequences = [torch.nonzero(elem == self.eos_token_id).squeeze(-1).tolist() for elem in input_ids]
-
-        # prediction to range in the input_ids
-        pred2range = [
-            {l[i]: (1, l[i] + 1) if i == 0 else (l[i - 1] + 1, l[i] + 1) for i in range(len(l))}
-            for l in remained_sequences
-        ]
-
-        # prediction to the idx of the sentence
-        pred2idx = [{x: i for i, x in enumerate(p)} for p in remained_sequences]
-
-        # expand ordered_sequences and remained_sequences
-        ordered_sequences = [l.copy() for l in ordered_sequences for _ in range(num_beams)]
-        remained_sequences = [l.copy() for l in remained_sequences for _ in range(num_beams)]
-
         # get encoder and store encoder outputs
         encoder = self.get_encoder()
 
-        encoder_outputs: tuple = encoder(input_ids, attention_mask=attention_mask)
+        if encoder_outputs is None:
+            encoder_outputs: tuple = encoder(input_ids, attention_mask=attention_mask)
 
         # create decoder_input_ids and decoder_attention_mask
-        decoder_token_ids = decoder_start_token_ids + [-1] * (sequence_length - len(decoder_start_token_ids))
+        decoder_token_ids = decoder_start_token_ids + [self.pad_token_id] * (sequence_length - len(decoder_start_token_ids))
         decoder_input_ids = torch.tensor(
             decoder_token_ids,
             dtype=torch.long,
@@ -169,33 +211,30 @@ class OrderingMixin:
             effective_batch_size * num_beams, sequence_length
         )  # shape: (batch_size * num_return_sequences * num_beams, sequence_length)
 
+        # the sequences are represented by the positions of their eos tokens in the input_ids
+        # already ordered sequences
+        used = torch.zeros_like(input_ids, dtype=torch.bool)
+        # ordered sequences, -1 = not ordered yet
+        ordered = torch.full_like(input_ids, -1)
+
         assert (
             batch_size == encoder_outputs[0].shape[0]
         ), f"expected encoder_outputs[0] to have 1st dimension bs={batch_size}, got {encoder_outputs[0].shape[0]} "
 
-        # expand batch_idx to assign correct encoder output for expanded input_ids (due to num_beams > 1 and num_return_sequences > 1)
-        expanded_batch_idxs = (
-            torch.arange(batch_size)
-            .view(-1, 1)
-            .repeat(1, num_beams * effective_batch_mult)
-            .view(-1)
-            .to(input_ids.device)
-        )
-        # expand encoder_outputs
-        encoder_outputs = (
-            encoder_outputs[0].index_select(0, expanded_batch_idxs),
-            *encoder_outputs[1:],
-        )
+        # expand encoder_outputs to assign correct encoder output for expanded input_ids (due to num_beams > 1)
+        if num_beams > 1:
+            encoder_outputs = (
+                encoder_outputs[0].repeat_interleave(num_beams * effective_batch_mult, dim=0),
+                *encoder_outputs[1:],
+            )
 
         if num_beams > 1:
             output = self._order_beam_search(
                 decoder_input_ids,
                 input_ids=input_ids,
                 done=done,
-                remained_sequences=remained_sequences,
-                pred2range=pred2range,
-                pred2idx=pred2idx,
-                ordered_sequences=ordered_sequences,
+                used=used,
+                ordered=ordered,
                 batch_size=effective_batch_size,
                 num_beams=num_beams,
                 sequence_length=sequence_length,
@@ -203,6 +242,7 @@ class OrderingMixin:
                 attention_mask=attention_mask,
                 use_cache=use_cache,
                 specific_head=specific_head,
+                sentence_level=sentence_level,
                 model_specific_kwargs=model_specific_kwargs,
             )
         else:
@@ -210,117 +250,338 @@ class OrderingMixin:
                 decoder_input_ids,
                 input_ids=input_ids,
                 done=done,
-                remained_sequences=remained_sequences,
-                pred2range=pred2range,
-                pred2idx=pred2idx,
-                ordered_sequences=ordered_sequences,
+                used=used,
+                ordered=ordered,
                 batch_size=effective_batch_size,
                 sequence_length=sequence_length,
                 encoder_outputs=encoder_outputs,
                 attention_mask=attention_mask,
                 use_cache=use_cache,
                 specific_head=specific_head,
+                sentence_level=sentence_level,
                 model_specific_kwargs=model_specific_kwargs,
             )
 
         return output
 
+    @torch.no_grad()
+    def sequence_score_matrices(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: Optional[torch.LongTensor] = None,
+        decoder_start_token_ids: Optional[List[int]] = None,
+    ) -> List[Tensor]:
+        """
+        Run the encoder and the decoder once and extract the pointer scores between all the sequences.
+
+        The decoder input contains the sequences in the input order, i.e. the scores of the sequences following
+        the sequence i are conditioned on the input order instead of the decoded prefix.
+
+        Returns a matrix of log-probabilities of shape (N, N) for each example with N sequences (including
+        the last, empty one marking the end of the input): the row 0 contains the scores of the first sequence,
+        the row i + 1 the scores of the sequence following the sequence i (see utils/permutation_search.py).
+        """
+        assert (
+            decoder_start_token_ids is not None
+        ), "decoder_start_token_ids has to be defined for encoder-decoder generation"
+
+        if attention_mask is None:
+            attention_mask = input_ids.new_ones(input_ids.shape)
+
+        sequence_length = input_ids.size(1)
+
+        # the decoder input is the input with the sequences in the original order
+        decoder_start_ids = input_ids.new_tensor(decoder_start_token_ids).expand(input_ids.size(0), -1)
+        decoder_input_ids = torch.cat([decoder_start_ids, input_ids[:, 1:]], dim=-1)[:, :sequence_length]
+
+        outputs = self(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            decoder_input_ids=decoder_input_ids,
+            use_cache=False,
+        )
+        # rows which are not eos are not used (log_softmax of -inf)
+        log_probs = F.log_softmax(outputs.logits, dim=-1)
+
+        # position of the input token `k` in the decoder input
+        offset = len(decoder_start_token_ids) - 1
+        matrices = []
+
+        for batch in range(input_ids.size(0)):
+            positions = torch.nonzero(input_ids[batch] == self.eos_token_id).squeeze(-1)
+            rows = torch.cat([positions.new_tensor([offset]), positions[:-1] + offset])
+            # the columns of the logits are the sequences in the input order
+            matrices.append(log_probs[batch, rows, : positions.size(0)].cpu())
+
+        return matrices
+
+    def order_pairwise(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: Optional[torch.LongTensor] = None,
+        decoder_start_token_ids: Optional[List[int]] = None,
+        exact_max_sequences: int = 10,
+    ) -> List[List[int]]:
+        """
+        Order the sequences in `input_ids` non-autoregressively: extract the matrix of pairwise scores
+        with a single forward pass (see `sequence_score_matrices`) and find the permutation with the best
+        total score, exactly for up to `exact_max_sequences` sequences and heuristically for longer inputs.
+
+        The output has the same format as the output of `order` (the last sequence is the end marker).
+        """
+        matrices = self.sequence_score_matrices(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            decoder_start_token_ids=decoder_start_token_ids,
+        )
+        return [
+            best_path(matrix.numpy(), exact_max_sequences=exact_max_sequences) + [matrix.size(0) - 1]
+            for matrix in matrices
+        ]
+
+    @torch.no_grad()
+    def order_exhaustive(
+        self,
+        input_ids: torch.LongTensor,
+        attention_mask: Optional[torch.LongTensor] = None,
+        decoder_start_token_ids: Optional[List[int]] = None,
+    ) -> List[List[int]]:
+        """
+        Order the sequences in `input_ids` by scoring all their permutations in a single teacher-forced
+        forward pass and taking the permutation with the highest log-probability (i.e. an exact search).
+        Feasible only for inputs with a few sequences (N! decoder rows per example).
+
+        The output has the same format as the output of `order` (the last sequence is the end marker).
+        """
+        assert (
+            decoder_start_token_ids is not None
+        ), "decoder_start_token_ids has to be defined for encoder-decoder generation"
+
+        if attention_mask is None:
+            attention_mask = input_ids.new_ones(input_ids.shape)
+
+        spans_batch = self._sequence_spans(input_ids)
+        example_idxs = []
+        permutations = []
+
+        for batch, spans in enumerate(spans_batch):
+            # the last sequence (end marker) is always the last one
+            for permutation in itertools.permutations(range(len(spans) - 1)):
+                example_idxs.append(batch)
+                permutations.append(list(permutation) + [len(spans) - 1])
+
+        decoder_input_ids, queries, query_mask = self._permuted_decoder_inputs(
+            input_ids, [spans_batch[batch] for batch in example_idxs], permutations, decoder_start_token_ids
+        )
+        # the gold sequences are the permuted sequences
+        targets = input_ids.new_tensor([p + [0] * (queries.size(1) - len(p)) for p in permutations])
+
+        # encode each example only once and share the encoder outputs among its permutations
+        example_idxs = input_ids.new_tensor(example_idxs)
+        encoder_outputs = self.get_encoder()(input_ids, attention_mask=attention_mask)
+
+        outputs = self(
+            input_ids=input_ids[example_idxs],
+            attention_mask=attention_mask[example_idxs],
+            encoder_outputs=(encoder_outputs[0][example_idxs],),
+            decoder_input_ids=decoder_input_ids,
+            use_cache=False,
+        )
+        log_probs = F.log_softmax(outputs.logits, dim=-1)
+
+        rows = torch.arange(decoder_input_ids.size(0), device=decoder_input_ids.device).unsqueeze(-1)
+        scores = log_probs[rows, queries, targets].masked_fill(query_mask == 0, 0.0).sum(-1).tolist()
+
+        best = {}
+        for example_idx, permutation, score in zip(example_idxs.tolist(), permutations, scores):
+            if example_idx not in best or score > best[example_idx][0]:
+                best[example_idx] = (score, permutation)
+
+        return [best[batch][1] for batch in range(input_ids.size(0))]
+
+    def _sequence_spans(self, input_ids):
+        """
+        Return the token ids of each sequence (including its eos token) for each example.
+        """
+        sequence_mask = input_ids == self.eos_token_id
+        sequence_begins = self._sequence_begins(sequence_mask)
+        spans_batch = []
+
+        for batch in range(input_ids.size(0)):
+            ids = input_ids[batch].tolist()
+            positions = torch.nonzero(sequence_mask[batch]).squeeze(-1).tolist()
+            begins = sequence_begins[batch, positions].tolist()
+            spans_batch.append([ids[begin : end + 1] for begin, end in zip(begins, positions)])
+
+        return spans_batch
+
+    def _permuted_decoder_inputs(self, input_ids, spans_batch, permutations, decoder_start_token_ids):
+        """
+        Build the teacher-forced decoder inputs with the sequences in the order given by the permutations
+        (the last item of each permutation is the end marker, which is not copied to the decoder).
+
+        Returns the padded decoder_input_ids, the decoder positions where the pointer is evaluated
+        (the last start token and the eos tokens of the copied sequences) and the mask of the valid positions.
+        """
+        decoder_rows = []
+        query_rows = []
+
+        for spans, permutation in zip(spans_batch, permutations):
+            decoder_ids = list(decoder_start_token_ids)
+            queries = [len(decoder_ids) - 1]
+
+            for idx in permutation[:-1]:
+                decoder_ids += spans[idx]
+                queries.append(len(decoder_ids) - 1)
+
+            decoder_rows.append(decoder_ids)
+            query_rows.append(queries)
+
+        decoder_length = max(len(row) for row in decoder_rows)
+        query_length = max(len(row) for row in query_rows)
+
+        decoder_input_ids = input_ids.new_tensor(
+            [row + [self.pad_token_id] * (decoder_length - len(row)) for row in decoder_rows]
+        )
+        queries = input_ids.new_tensor([row + [0] * (query_length - len(row)) for row in query_rows])
+        query_mask = input_ids.new_tensor([[1] * len(row) + [0] * (query_length - len(row)) for row in query_rows])
+
+        return decoder_input_ids, queries, query_mask
+
+    def _sequence_begins(self, sequence_mask):
+        """
+        For each eos position, return the position in the input where the sequence ending with the eos begins
+        (the position after the previous eos, or after the leading bos for the first sequence).
+        """
+        positions = torch.arange(sequence_mask.size(1), device=sequence_mask.device).expand_as(sequence_mask)
+        last_eos = torch.cummax(positions * sequence_mask, dim=-1).values
+
+        return F.pad(last_eos[:, :-1], (1, 0)) + 1
+
+    def _copy_sequences(self, decoder_input_ids, input_ids, sequence_begins, next_sequence, selected, decoder_step):
+        """
+        Copy the sequences `next_sequence` from `input_ids` to `decoder_input_ids` starting at `decoder_step + 1`
+        in the rows where `selected` is True. The sequences are truncated at the length of `decoder_input_ids`.
+        """
+        next_sequence = next_sequence.clamp(min=0).unsqueeze(-1)
+        begin = sequence_begins.gather(1, next_sequence)
+        length = next_sequence + 1 - begin
+
+        offset = torch.arange(decoder_input_ids.size(1), device=decoder_input_ids.device) - (decoder_step + 1)
+        copy = selected.unsqueeze(-1) & (offset >= 0) & (offset < length)
+        source = (begin + offset).clamp(0, input_ids.size(1) - 1)
+
+        return torch.where(copy, input_ids.gather(1, source), decoder_input_ids)
+
+    def _append_ordered(self, ordered, used, next_sequence, selected):
+        """
+        Append the sequences `next_sequence` to `ordered` in the rows where `selected` is True.
+        Must be called before the sequences are marked in `used`.
+        """
+        column = used.sum(-1, keepdim=True).clamp(max=ordered.size(1) - 1)
+        value = torch.where(selected.unsqueeze(-1), next_sequence.unsqueeze(-1), ordered.gather(1, column))
+
+        return ordered.scatter(1, column, value)
+
+    def _ordered_to_indices(self, ordered, sequence_mask):
+        """
+        Convert the ordered eos positions to the indices of the sequences.
+        """
+        sequence_index = sequence_mask.long().cumsum(-1) - 1
+        indices = sequence_index.gather(1, ordered.clamp(min=0)).masked_fill(ordered < 0, -1)
+
+        return [[idx for idx in row if idx >= 0] for row in indices.tolist()]
+
     def _order_no_beam_search(
         self,
         decoder_input_ids,
         input_ids,
         done,
-        ordered_sequences,
-        remained_sequences,
-        pred2range,
-        pred2idx,
+        used,
+        ordered,
         batch_size,
         sequence_length,
         encoder_outputs,
         attention_mask,
         use_cache,
         specific_head,
+        sentence_level,
         model_specific_kwargs,
     ):
 
         past = None
-
-        decoder_step = 0
+        # number of decoder positions stored in `past`, only the positions after it are fed to the model
+        past_length = 0
+        # projected keys of the pointer, computed in the first step
+        pointer_keys = None
+        # positions of the sequences (eos tokens) to order
+        sequence_mask = input_ids == self.eos_token_id
+        sequence_begins = self._sequence_begins(sequence_mask)
+
+        decoder_step = self._next_decoder_step(decoder_input_ids, -1, done, sentence_level)
         while decoder_step < sequence_length:
             model_inputs = self.prepare_inputs_for_generation(
-                decoder_input_ids=decoder_input_ids[:, : decoder_step + 1],
+                decoder_input_ids=decoder_input_ids[:, past_length : decoder_step + 1],
                 past=past,
                 input_ids=input_ids,
                 attention_mask=attention_mask,
                 use_cache=True,
                 encoder_outputs=encoder_outputs,
+                pointer_keys=pointer_keys,
             )
             outputs = self(**model_inputs)
+            pointer_keys = outputs.pointer_keys
 
             if specific_head == None:
                 next_sequence_logits = outputs.logits[:, -1, :]
             else:
                 next_sequence_logits = outputs.head_logits[:, specific_head, -1, :]
 
+            next_sequence_logits = self._sequence_logits_to_positions(
+                next_sequence_logits, outputs.sequence_positions, sequence_length
+            )
+
             scores = self.postprocess_next_sequence_scores(
                 scores=next_sequence_logits,
                 decoder_input_id=decoder_input_ids[:, decoder_step],
                 done=done,
-                ordered_sequences=ordered_sequences,
-                batch_size=batch_size,
-                num_beams=1,
+                used=used,
             )
 
             # if model has past, then set the past variable to speed up decoding
             if self._use_cache(outputs, use_cache):
                 past = outputs.past_key_values
+                past_length = decoder_step + 1
 
             next_sequence = torch.argmax(scores, dim=-1)
-            next_sequence_mask = ~((scores != float("-inf")).any(-1))
             # ignore next token for token != eos (see self.postprocess_next_sequence_scores)
-            next_sequence[next_sequence_mask] = -100
-
-            for batch in range(batch_size):
-                prediction = int(next_sequence[batch])
-                # ignore next token
-                if prediction == -100:
-                    continue
-                # get the next sequence ids from input_ids
-                begin, end = pred2range[batch][prediction]
-                next_sequence_ids = input_ids[batch][begin:end]
-                # add next_sequence_ids to the decoder_input_ids
-                decoder_input_ids[
-                    batch, decoder_step + 1 : decoder_step + 1 + next_sequence_ids.size(0)
-                ] = next_sequence_ids[: decoder_input_ids.size(1) - (decoder_step + 1)]
-
-                ordered_sequences[batch].append(prediction)
-                # remove sequence from remained_sequences
-                remained_sequences[batch].remove(prediction)
-                # done if all sequences ordered
-                if len(remained_sequences[batch]) == 0 and done[batch] == False:
-                    done[batch] = True
-                    # replace -1 by pad tokens to avoid errors
-                    decoder_input_ids[batch][decoder_input_ids[batch] == -1] = self.pad_token_id
-
-            decoder_step = decoder_step + 1
+            selected = (scores != float("-inf")).any(-1)
+
+            # add the next sequences to the decoder_input_ids
+            decoder_input_ids = self._copy_sequences(
+                decoder_input_ids, input_ids, sequence_begins, next_sequence, selected, decoder_step
+            )
+            ordered = self._append_ordered(ordered, used, next_sequence, selected)
+            used = self._mark_used(used, next_sequence, selected)
+            # done if all sequences ordered
+            done = done | ~(sequence_mask & ~used).any(-1)
+
+            decoder_step = self._next_decoder_step(decoder_input_ids, decoder_step, done, sentence_level)
 
             # stop when there is a </s> in each sentence, or if we exceed the maximul length
             if done.all() == True:
                 break
 
         # get the sequence idx and add to results
-        results = [[pred2idx[batch][pred] for pred in ordered_sequences[batch]] for batch in range(batch_size)]
-        return results
+        return self._ordered_to_indices(ordered, sequence_mask)
 
     def _order_beam_search(
         self,
         decoder_input_ids,
         input_ids,
         done,
-        ordered_sequences,
-        remained_sequences,
-        pred2range,
-        pred2idx,
+        used,
+        ordered,
         batch_size,
         num_beams,
         sequence_length,
@@ -328,42 +589,59 @@ class OrderingMixin:
         attention_mask,
         use_cache,
         specific_head,
+        sentence_level,
         model_specific_kwargs,
     ):
 
         # scores for each sentence in the beam
         beam_scores = torch.ones((batch_size, num_beams), dtype=torch.float, device=input_ids.device)
         beam_scores = beam_scores.view(-1)  # shape (batch_size * num_beams,)
-        # steps for each sentence in the beam
-        beam_steps = torch.zeros((batch_size, num_beams), dtype=torch.float, device=input_ids.device)
-        beam_steps = beam_steps.view(-1)  # shape (batch_size * num_beams,)
+
+        # index of the first beam of each batch for each beam
+        batch_beam_offset = torch.arange(batch_size, device=input_ids.device).repeat_interleave(num_beams) * num_beams
 
         # cache compute states
         past = None
-
-        decoder_step = 0
+        # number of decoder positions stored in `past`, only the positions after it are fed to the model
+        past_length = 0
+        # projected keys of the pointer, computed in the first step
+        # (the same for all the beams of an example -> no need to reorder them)
+        pointer_keys = None
+        # positions of the sequences (eos tokens) to order
+        sequence_mask = input_ids == self.eos_token_id
+        sequence_begins = self._sequence_begins(sequence_mask)
+
+        decoder_step = self._next_decoder_step(decoder_input_ids, -1, done, sentence_level)
         while decoder_step < sequence_length:
 
             model_inputs = self.prepare_inputs_for_generation(
-                decoder_input_ids=decoder_input_ids[:, : decoder_step + 1],
+                decoder_input_ids=decoder_input_ids[:, past_length : decoder_step + 1],
                 past=past,
                 input_ids=input_ids,
                 attention_mask=attention_mask,
                 use_cache=True,
                 encoder_outputs=encoder_outputs,
+                pointer_keys=pointer_keys,
             )
 
-            outputs = self(**model_inputs)  # (batch_size * num_beams, cur_len, sequence_length)
+            outputs = self(**model_inputs)  # (batch_size * num_beams, cur_len, N)
+            pointer_keys = outputs.pointer_keys
+
             if specific_head == None:
                 next_sequence_logits = outputs.logits[:, -1, :]
             else:
                 next_sequence_logits = outputs.head_logits[
                     :, specific_head, -1, :
-                ]  # (batch_size * num_beams, sequence_length)
+                ]  # (batch_size * num_beams, N)
+
+            next_sequence_logits = self._sequence_logits_to_positions(
+                next_sequence_logits, outputs.sequence_positions, sequence_length
+            )  # (batch_size * num_beams, sequence_length)
 
             # if model has past, then set the past variable to speed up decoding
             if self._use_cache(outputs, use_cache):
                 past = outputs.past_key_values
+                past_length = decoder_step + 1
 
             scores = F.log_softmax(next_sequence_logits, dim=-1)  # (batch_size * num_beams, sequence_length)
 
@@ -371,19 +649,15 @@ class OrderingMixin:
                 scores=scores,
                 decoder_input_id=decoder_input_ids[:, decoder_step],
                 done=done,
-                ordered_sequences=ordered_sequences,
-                batch_size=batch_size,
-                num_beams=num_beams,
+                used=used,
             )
 
-            next_sequence_mask = ~((scores != float("-inf")).any(-1))
             # for each beam, set the score of the first token to the beam score
             # if there is no next sequence scores (i.e. not eos or beam done).
             # this is to compare beam scores after
-            for idx, score in enumerate(scores):
-                if not (score == float("-inf")).all():
-                    continue
-                scores[idx, 0] = beam_scores[idx]
+            # (the first token is bos and never represents a sequence)
+            has_next_sequence = (scores != float("-inf")).any(-1)
+            scores[:, 0] = beam_scores.masked_fill(has_next_sequence, float("-inf"))
 
             assert scores.shape == (
                 batch_size * num_beams,
@@ -394,131 +668,58 @@ class OrderingMixin:
             # the score is the mean of all sequences scores.
             # this does not follow the original beam search algorithm
             # but it is to handle the issue that every beam does not have the same number of sentences.
-            next_scores = (
-                scores + (beam_steps[:, None].expand_as(scores) * beam_scores[:, None].expand_as(scores))
-            ) / (
-                beam_steps[:, None].expand_as(scores) + 1
+            beam_steps = used.sum(-1, keepdim=True).float()
+            next_scores = (scores + beam_steps * beam_scores.unsqueeze(-1)) / (
+                beam_steps + 1
             )  # (batch_size * num_beams, sequence_length)
 
+            # make sure that only next sequences of the first beam are considered to avoid sampling the exact same sequences num_beams times
+            first_step = (beam_steps.view(batch_size, num_beams) == 0).all(-1)
+            next_scores = next_scores.view(batch_size, num_beams, sequence_length)
+            next_scores[:, 1:] -= 1e9 * first_step.view(batch_size, 1, 1).float()
+
             # re-organize to group the beam together (we are keeping top hypothesis accross beams)
             next_scores = next_scores.view(
                 batch_size, num_beams * sequence_length
             )  # (batch_size, num_beams * sequence_length)
 
-            # make sure that only next sequences of the first beam are considered to avoid sampling the exact same sequences num_beams times
-            if beam_steps.sum() == 0:
-                next_scores.view(batch_size, num_beams, sequence_length)[:, 1:] += -1e9
-
             topk_next_scores, topk_next_sequences = torch.topk(
-                next_scores, 2 * num_beams, dim=1, largest=True, sorted=True
+                next_scores, num_beams, dim=1, largest=True, sorted=True
             )
 
-            assert topk_next_scores.size() == topk_next_sequences.size() == (batch_size, 2 * num_beams)
-
-            # next batch beam content
-            next_batch_beam = []
-
-            # for each sentence
-            for batch_idx in range(batch_size):
-
-                # next sentence beam content, this will get added to next_batch_beam
-                next_sent_beam = []
-
-                # next tokens for this sentence
-                for beam_token_rank, (beam_token_id, beam_token_score) in enumerate(
-                    zip(topk_next_sequences[batch_idx], topk_next_scores[batch_idx])
-                ):
-
-                    # once the beam is full, don't add more tokens to it.
-                    if len(next_sent_beam) == num_beams:
-                        break
-
-                    # once all ordering possibilities have been explored
-                    # pad if bean is not full
-                    if beam_token_score == float("-inf"):
-                        next_sent_beam.extend(
-                            [(-1e9, self.pad_token_id, False, 0)] * (num_beams - len(next_sent_beam))
-                        )
-                        break
-
-                    # get beam and token IDs
-                    beam_id = (beam_token_id // sequence_length).item()
-                    token_id = (beam_token_id % sequence_length).item()
-
-                    effective_beam_id = batch_idx * num_beams + beam_id
-
-                    # if we are done with this sentence, add a pad token
-                    if done[effective_beam_id]:
-                        next_sent_beam.append(
-                            (beam_token_score, self.pad_token_id, False, effective_beam_id)
-                        )  # pad the batch
-                        continue
-
-                    # get new_sequence.
-                    # True if the token_id referes to a new sequence
-                    # False if not
-                    new_sequence = not (
-                        (
-                            next_scores.view(batch_size * num_beams, sequence_length)[effective_beam_id]
-                            != float("-inf")
-                        ).sum()
-                        == 1
-                        and token_id == 0
-                    )
-
-                    # set token_id to the next token_id of the sequence if it is not a new_sequence
-                    if not new_sequence:
-                        token_id = decoder_input_ids[effective_beam_id, decoder_step + 1]
-
-                    # add next predicted token
-                    next_sent_beam.append((beam_token_score, token_id, new_sequence, effective_beam_id))
-
-                # update next beam content
-                assert (
-                    len(next_sent_beam) == num_beams
-                ), f"Beam should always be full ({len(next_sent_beam)}/{num_beams})"
-                next_batch_beam.extend(next_sent_beam)
-                assert len(next_batch_beam) == num_beams * (batch_idx + 1), "We should have added num_beams each step"
-
-            # sanity check / prepare next batch
-            assert len(next_batch_beam) == batch_size * num_beams
-            beam_scores = beam_scores.new([x[0] for x in next_batch_beam])
-            beam_tokens = input_ids.new([x[1] for x in next_batch_beam])
-            beam_new_sequence = input_ids.new([x[2] for x in next_batch_beam])
-            beam_idx = input_ids.new([x[3] for x in next_batch_beam])
-
-            beam_steps = beam_steps[beam_idx]
-            beam_steps = beam_steps.new(
-                [step + 1 if x[2] == True else step for step, x in zip(beam_steps, next_batch_beam)]
-            )
+            assert topk_next_scores.size() == topk_next_sequences.size() == (batch_size, num_beams)
+
+            # get beam and sequence IDs
+            topk_next_scores = topk_next_scores.view(-1)
+            topk_next_sequences = topk_next_sequences.view(-1)
+            beam_idx = batch_beam_offset + torch.div(topk_next_sequences, sequence_length, rounding_mode="floor")
+            next_sequence = topk_next_sequences % sequence_length
+
+            # once all ordering possibilities have been explored, pad the beam
+            valid = topk_next_scores != float("-inf")
+            beam_idx = torch.where(valid, beam_idx, batch_beam_offset)
+            beam_scores = topk_next_scores.masked_fill(~valid, -1e9)
 
             # re-order according to the beam idx
             done = done[beam_idx]
-            ordered_sequences = [ordered_sequences[i].copy() for i in beam_idx]
-            remained_sequences = [remained_sequences[i].copy() for i in beam_idx]
-
-            # re-order batch and update current length
+            used = used[beam_idx]
+            ordered = ordered[beam_idx]
             decoder_input_ids = decoder_input_ids[beam_idx, :]
-            for idx in range(batch_size * num_beams):
-                batch_idx = idx // num_beams
-                if beam_new_sequence[idx] == False:
-                    decoder_input_ids[idx, decoder_step + 1] = beam_tokens[idx]
-                else:
-                    next_sequence_pred = int(beam_tokens[idx])
-                    # get the next sequence ids from input_ids
-                    begin, end = pred2range[batch_idx][next_sequence_pred]
-                    next_sequence_ids = input_ids[idx][begin:end]
-                    # add next_sequence_ids to the decoder_input_ids
-                    decoder_input_ids[
-                        idx, decoder_step + 1 : decoder_step + 1 + next_sequence_ids.size(0)
-                    ] = next_sequence_ids[: decoder_input_ids.size(1) - (decoder_step + 1)]
-                    ordered_sequences[idx].append(next_sequence_pred)
-                    # remove sequence from remained_sequences
-                    remained_sequences[idx].remove(next_sequence_pred)
-                    # Check if the beam is done
-                    done[idx] = done[idx] or len(remained_sequences[idx]) == 0
-
-            decoder_step = decoder_step + 1
+
+            # the first token refers to keeping the beam without a new sequence
+            new_sequence = valid & ~done & (next_sequence != 0)
+            done = done | ~valid
+
+            # add the new sequences to the decoder_input_ids
+            decoder_input_ids = self._copy_sequences(
+                decoder_input_ids, input_ids, sequence_begins, next_sequence, new_sequence, decoder_step
+            )
+            ordered = self._append_ordered(ordered, used, next_sequence, new_sequence)
+            used = self._mark_used(used, next_sequence, new_sequence)
+            # check if the beam is done
+            done = done | ~(sequence_mask & ~used).any(-1)
+
+            decoder_step = self._next_decoder_step(decoder_input_ids, decoder_step, done, sentence_level)
 
             # stop when we are done with each sentence
             if done.all() == True:
@@ -530,11 +731,7 @@ class OrderingMixin:
 
         # find the best beam for each batch
         best_beam = beam_scores.view(batch_size, num_beams).argmax(-1)
-        ordered_sequences = [
-            ordered_sequences[idx]
-            for idx in (best_beam + torch.arange(0, batch_size, device=best_beam.device) * num_beams)
-        ]
+        best_beam = best_beam + torch.arange(0, batch_size, device=best_beam.device) * num_beams
 
         # get the sequence idx and add to results
-        results = [[pred2idx[batch][pred] for pred in ordered_sequences[batch]] for batch in range(batch_size)]
-        return results
+        return self._ordered_to_indices(ordered[best_beam], sequence_mask[best_beam])
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+"""
+Search for the best order of sequences given a matrix of pairwise successor scores.
+
+The matrix `scores` has the shape (m + 1, m + 1) for m sequences to order:
+    - scores[0, j] = score of the sequence j being the first one,
+    - scores[i + 1, j] = score of the sequence j following the sequence i,
+    - the last column (j = m) = score of ending the text after the sequence i.
+
+The score of an order is the sum of the scores of its transitions (including the first and the last one).
+"""
+
+import numpy as np
+
+
+def path_score(scores, path):
+    """
+    Return the score of the order `path` (a permutation of range(m)).
+    """
+    prev = [0] + [p + 1 for p in path]
+    nxt = list(path) + [len(path)]
+
+    return scores[prev, nxt].sum()
+
+
+def best_path_exact(scores):
+    """
+    Find the best order with the Held-Karp dynamic programming, O(2^m * m^2).
+    """
+    m = scores.shape[0] - 1
+
+    if m == 0:
+        return []
+
+    items = np.arange(m)
+    # transitions[i, j] = score of the sequence j following the sequence i
+    transitions = scores[1:, :m]
+
+    # dp[mask, last] = best score of ordering the sequences in `mask` ending with the sequence `last`
+    dp = np.full((1 << m, m), -np.inf)
+    parent = np.full((1 << m, m), -1, dtype=np.int64)
+    dp[1 << items, items] = scores[0, :m]
+
+    for mask in range(1, 1 << m):
+        in_mask = ((mask >> items) & 1).astype(bool)
+
+        if in_mask.all() or not np.isfinite(dp[mask]).any():
+            continue
+
+        candidates = dp[mask][:, None] + transitions
+        best_last = candidates.argmax(0)
+        best = candidates[best_last, items]
+
+        for nxt in items[~in_mask]:
+            new_mask = mask | (1 << nxt)
+
+            if best[nxt] > dp[new_mask, nxt]:
+                dp[new_mask, nxt] = best[nxt]
+                parent[new_mask, nxt] = best_last[nxt]
+
+    mask = (1 << m) - 1
+    last = int(np.argmax(dp[mask] + scores[1:, m]))
+    path = []
+
+    while last != -1:
+        path.append(last)
+        prev = int(parent[mask, last])
+        mask ^= 1 << last
+        last = prev
+
+    return path[::-1]
+
+
+def best_path_heuristic(scores, max_iterations=100):
+    """
+    Find an order greedily (always taking the best next sequence) and improve it with 2-opt moves
+    (reversing a part of the order) until no move improves the score.
+    """
+    m = scores.shape[0] - 1
+    path = []
+    remaining = set(range(m))
+    prev = 0
+
+    while remaining:
+        nxt = max(remaining, key=lambda j: scores[prev, j])
+        path.append(nxt)
+        remaining.remove(nxt)
+        prev = nxt + 1
+
+    best_score = path_score(scores, path)
+
+    for _ in range(max_iterations):
+        improved = False
+
+        for i in range(m - 1):
+            for j in range(i + 1, m):
+                candidate = path[:i] + path[i:j + 1][::-1] + path[j + 1:]
+                score = path_score(scores, candidate)
+
+                if score > best_score + 1e-9:
+                    path, best_score = candidate, score
+                    improved = True
+
+        if not improved:
+            break
+
+    return path
+
+
+def best_path(scores, exact_max_sequences=10):
+    """
+    Find the best order exactly for up to `exact_max_sequences` sequences, heuristically otherwise.
+    """
+    if scores.shape[0] - 1 <= exact_max_sequences:
+        return best_path_exact(scores)
+
+    return best_path_heuristic(scores)
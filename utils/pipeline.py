@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Overlapping the CPU-bound pre- and post-processing of the batches with the model forward passes.
+"""
+
+import collections
+import logging
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+_END = object()
+
+
+class BatchPipeline:
+    """
+    Process the batches in three stages: `prepare` (tokenization, tensor construction) -> `run` (the model) ->
+    `finish` (detokenization, post-processing). With `prefetch` > 0, the batch k + 1 is prepared and the batch k - 1
+    is finished in background threads while the model runs on the batch k. At most `prefetch` batches wait
+    in each stage. With `prefetch` = 0, the batches are processed sequentially.
+
+    The time for which the model waited for the prepared batches or for the finishing threads (stall time)
+    is accumulated over all the calls in `stall_time` (and `run_time` for the model).
+    """
+    def __init__(self, prefetch=2, name="pipeline"):
+        self.prefetch = prefetch
+        self.name = name
+        self.run_time = 0.0
+        self.stall_time = 0.0
+
+    def __call__(self, batches, prepare, run, finish):
+        """
+        Yield `finish(batch, run(prepare(batch)))` for each of `batches` in their original order.
+        """
+        if self.prefetch <= 0:
+            for batch in batches:
+                inputs = prepare(batch)
+
+                start = time.time()
+                output = run(inputs)
+                self.run_time += time.time() - start
+
+                yield finish(batch, output)
+            return
+
+        run_time, stall_time = self.run_time, self.stall_time
+        batches = iter(batches)
+
+        # the tokenizers and the model release the GIL, the threads run in parallel with the model
+        with ThreadPoolExecutor(1) as prepare_pool, ThreadPoolExecutor(1) as finish_pool:
+            prepared = collections.deque()
+            finished = collections.deque()
+
+            def submit_prepare():
+                batch = next(batches, _END)
+
+                if batch is not _END:
+                    prepared.append((batch, prepare_pool.submit(prepare, batch)))
+
+            for _ in range(self.prefetch):
+                submit_prepare()
+
+            while prepared:
+                batch, inputs = prepared.popleft()
+
+                start = time.time()
+                inputs = inputs.result()
+                self.stall_time += time.time() - start
+
+                submit_prepare()
+
+                start = time.time()
+                output = run(inputs)
+                self.run_time += time.time() - start
+
+                finished.append(finish_pool.submit(finish, batch, output))
+
+                while len(finished) > self.prefetch:
+                    start = time.time()
+                    output = finished.popleft().result()
+                    self.stall_time += time.time() - start
+
+                    yield output
+
+            while finished:
+                yield finished.popleft().result()
+
+        logger.debug(f"{self.name}: model {self.run_time - run_time:.2f} s, "
+            f"stalled {self.stall_time - stall_time:.2f} s")
+
+    def log_stats(self):
+        if self.run_time > 0:
+            logger.info(f"{self.name}: model {self.run_time:.2f} s, stalled {self.stall_time:.2f} s "
+                f"({100 * self.stall_time / (self.run_time + self.stall_time):.1f} %) waiting for the pre- / post-processing")
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+
+"""
+Reading and writing datasets incrementally (without loading the whole dataset into memory).
+"""
+
+import itertools
+import json
+import os
+import re
+
+
+def read_examples(filename, field="data", chunk_size=1 << 20):
+    """
+    Iterate over the examples in a JSONL file (one example per line) or in a JSON file with the examples
+    in the list `field` (the format used by the preprocessing scripts).
+    """
+    if filename.endswith(".jsonl"):
+        with open(filename) as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        return
+
+    decoder = json.JSONDecoder()
+    separator = re.compile(r"[\s,]*")
+
+    with open(filename) as f:
+        buffer = ""
+
+        # skip to the beginning of the list
+        while True:
+            match = re.search(rf'"{field}"\s*:\s*\[', buffer)
+
+            if match:
+                break
+
+            chunk = f.read(chunk_size)
+
+            if not chunk:
+                raise ValueError(f"Field '{field}' not found in {filename}")
+
+            buffer += chunk
+
+        idx = match.end()
+
+        while True:
+            idx = separator.match(buffer, idx).end()
+
+            if idx < len(buffer) and buffer[idx] == "]":
+                return
+
+            try:
+                example, idx = decoder.raw_decode(buffer, idx)
+            except json.JSONDecodeError:
+                # the example is not complete yet
+                chunk = f.read(chunk_size)
+
+                if not chunk:
+                    raise
+
+                buffer = buffer[idx:] + chunk
+                idx = 0
+                continue
+
+            yield example
+
+
+def input_filename(in_dir, split):
+    """
+    Return the JSONL version of the split if it exists, the JSON version otherwise.
+    """
+    filename = os.path.join(in_dir, f"{split}.jsonl")
+
+    if os.path.exists(filename):
+        return filename
+
+    return os.path.join(in_dir, f"{split}.json")
+
+
+def chunks(iterable, size):
+    """
+    Split the iterable into lists of `size` items.
+    """
+    iterator = iter(iterable)
+
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+def write_example(f, example):
+    f.write(json.dumps(example, ensure_ascii=False) + "\n")
+
+
+class OrderedWriter:
+    """
+    Write the outputs in the original order of the examples even if they are produced in a different order
+    (e.g. in batches sorted by length). The outputs are buffered until all the preceding outputs are written.
+    """
+    def __init__(self, f):
+        self.f = f
+        self.next_idx = 0
+        self.pending = {}
+
+    def write(self, text, idx=None):
+        """
+        Write `text` as the output for the example `idx` (the example following the last received one if None).
+        """
+        if idx is None:
+            idx = self.next_idx + len(self.pending)
+
+        self.pending[idx] = text
+
+        while self.next_idx in self.pending:
+            self.f.write(self.pending.pop(self.next_idx))
+            self.next_idx += 1
+
+    def close(self, num_examples=None):
+        if self.pending:
+            raise ValueError(f"Missing outputs for examples {self.next_idx}..{min(self.pending) - 1}")
+
+        if num_examples is not None and self.next_idx != num_examples:
+            raise ValueError(f"Outputs for {self.next_idx} examples, expected {num_examples}")
+
+        self.f.close()
+
+
+class ExampleWriter:
+    """
+    Write the output examples as JSONL (one example per line, stream=True) or as a JSON file with the examples
+    in the list "data" (written in `close`).
+    """
+    def __init__(self, out_filename, stream=False):
+        self.f = open(out_filename, "w")
+        self.stream = stream
+        self.examples = []
+        self.num_written = 0
+
+    def write(self, example, idx=None):
+        self.num_written += 1
+
+        if self.stream:
+            write_example(self.f, example)
+        else:
+            self.examples.append(example)
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self, num_examples=None):
+        if num_examples is not None and self.num_written != num_examples:
+            raise ValueError(f"Outputs for {self.num_written} examples, expected {num_examples}")
+
+        if not self.stream:
+            json.dump({"data": self.examples}, self.f, indent=4, ensure_ascii=False)
+
+        self.f.close()
+
+
+class ResumableWriter:
+    """
+    Crash-safe writer of the outputs (the interface of `OrderedWriter` / `ExampleWriter`). Each output is appended
+    to the journal `<out_filename>.partial` as a JSON record with the example index, the journal is synced
+    to the disk after every `sync_every` outputs. The output file is written in the original order of the examples
+    only in `close`, after which the journal is removed. Only the journal offsets of the records are kept
+    in memory, the outputs are read back from the journal.
+
+    If the journal exists (i.e. the previous run did not finish), the indices of the examples in the journal
+    are loaded to `completed` and the examples can be skipped. The outputs are strings written as they are
+    (format="text") or examples written as JSONL (format="jsonl") or as a JSON file with the list "data"
+    (format="json").
+    """
+    def __init__(self, out_filename, format="text", sync_every=100):
+        self.out_filename = out_filename
+        self.journal_filename = f"{out_filename}.partial"
+        self.format = format
+        self.sync_every = sync_every
+        # example index -> offset of the record in the journal
+        self.offsets = {}
+        self.journal_size = self._load_journal()
+        self.next_idx = max(self.offsets, default=-1) + 1
+        self.unsynced = 0
+        self.journal = open(self.journal_filename, "ab")
+
+    @property
+    def completed(self):
+        return self.offsets.keys()
+
+    def _load_journal(self):
+        if not os.path.exists(self.journal_filename):
+            return 0
+
+        valid_size = 0
+
+        with open(self.journal_filename, "rb") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Incomplete record")
+
+                    record = json.loads(line)
+                except ValueError:
+                    # the last record was not completely written before the crash
+                    break
+
+                self.offsets[record["idx"]] = valid_size
+                valid_size += len(line)
+
+        # the new records are appended after the last complete one
+        os.truncate(self.journal_filename, valid_size)
+
+        return valid_size
+
+    def write(self, output, idx=None):
+        """
+        Write `output` for the example `idx` (the example following the last written one if None).
+        The outputs of the completed examples are not written again.
+        """
+        if idx is None:
+            idx = self.next_idx
+
+        if idx in self.offsets:
+            return
+
+        record = (json.dumps({"idx": idx, "output": output}, ensure_ascii=False) + "\n").encode("utf-8")
+        self.journal.write(record)
+        self.offsets[idx] = self.journal_size
+        self.journal_size += len(record)
+        self.next_idx = max(self.next_idx, idx + 1)
+        self.unsynced += 1
+
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    def read(self, idx):
+        """
+        Read the output for the completed example `idx` from the journal.
+        """
+        self.journal.flush()
+
+        with open(self.journal_filename, "rb") as f:
+            f.seek(self.offsets[idx])
+            return json.loads(f.readline())["output"]
+
+    def flush(self):
+        self.journal.flush()
+
+    def sync(self):
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.unsynced = 0
+
+    def _read_outputs(self, num_examples):
+        with open(self.journal_filename, "rb") as f:
+            for i in range(num_examples):
+                f.seek(self.offsets[i])
+                yield json.loads(f.readline())["output"]
+
+    def close(self, num_examples):
+        """
+        Write the output file with the outputs of all the `num_examples` examples.
+        """
+        self.sync()
+        self.journal.close()
+
+        missing = next((i for i in range(num_examples) if i not in self.offsets), None)
+
+        if missing is not None:
+            raise ValueError(f"Missing output for example {missing}, the journal {self.journal_filename} is kept")
+
+        if len(self.offsets) != num_examples:
+            raise ValueError(f"Outputs for {len(self.offsets)} examples, expected {num_examples}, "
+                f"the journal {self.journal_filename} is kept")
+
+        outputs = self._read_outputs(num_examples)
+        tmp_filename = f"{self.out_filename}.tmp"
+
+        with open(tmp_filename, "w") as f:
+            if self.format == "json":
+                # the same layout as json.dump(..., indent=4), the examples are written one by one
+                f.write('{\n    "data": [')
+
+                for i, output in enumerate(outputs):
+                    example = json.dumps(output, indent=4, ensure_ascii=False).replace("\n", "\n        ")
+                    f.write(("," if i else "") + "\n        " + example)
+
+                f.write("\n    ]\n}" if num_examples else "]\n}")
+            elif self.format == "jsonl":
+                for output in outputs:
+                    write_example(f, output)
+            else:
+                f.writelines(outputs)
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        # the output file is either complete or not present
+        os.replace(tmp_filename, self.out_filename)
+        os.remove(self.journal_filename)